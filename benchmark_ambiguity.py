@@ -2,33 +2,39 @@
 Benchmark for independent AmbiguityAgent
 """
 
+import argparse
 import json
 import time
 from datetime import datetime
 from pathlib import Path
 from typing import List, Dict
 
+import pandas as pd
+from tqdm import tqdm
+
 from utils import AmbiguityAgent
+from utils.three_agents import QUANTIZATION_MODES, BACKENDS, SERVING_BACKENDS
 
 
 def load_queries(csv_path: str) -> List[str]:
-    """Load queries from CSV"""
-    import csv
-    queries = []
-    with open(csv_path, 'r', encoding='utf-8') as f:
-        reader = csv.reader(f)
-        next(reader)  # Skip header
-        for row in reader:
-            if row:
-                queries.append(row[0])
-    return queries
+    """Load queries (first column) from CSV"""
+    # Read everything as text so values like "NULL" or "NA" are not turned into NaN
+    df = pd.read_csv(csv_path, dtype=str, keep_default_na=False)
+    return df.iloc[:, 0].tolist()
 
 
 def benchmark_ambiguity(
     model_id: str = "TinyLlama/TinyLlama-1.1B-Chat-v1.0",
     queries_file: str = "./test_data/ambiguity_intent.csv",
     output_dir: str = "./results",
-    custom_instruction_key: str = None
+    custom_instruction_key: str = None,
+    batch_size: int = 32,
+    quantization: str = "auto",
+    backend: str = "eager",
+    prompt_cache: bool = False,
+    semantic_threshold: float = None,
+    draft_model: str = None,
+    logits_classifier: bool = False
 ):
     """
     Benchmark AmbiguityAgent on test queries
@@ -38,6 +44,14 @@ def benchmark_ambiguity(
         queries_file: Path to test queries CSV
         output_dir: Directory to save results
         custom_instruction_key: Optional custom instruction key
+        batch_size: Number of queries per batched generate call
+        quantization: Weight precision/quantization mode (see QUANTIZATION_MODES)
+        backend: Inference backend (see BACKENDS)
+        prompt_cache: Serve repeated prompts from the persistent prompt cache
+        semantic_threshold: Optional similarity for near-duplicate cache hits
+        draft_model: Optional small model for speculative decoding (targets >= 7B only)
+        logits_classifier: Classify from one forward pass's label logits instead of
+            generating an assessment
     """
     output_dir = Path(output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
@@ -48,6 +62,12 @@ def benchmark_ambiguity(
     print(f"Model: {model_id}")
     print(f"Queries: {queries_file}")
     print(f"Custom Instruction: {custom_instruction_key or 'Default'}")
+    print(f"Batch Size: {batch_size}")
+    print(f"Quantization: {quantization}")
+    print(f"Backend: {backend}")
+    print(f"Prompt Cache: {'On' if prompt_cache else 'Off'}")
+    print(f"Draft Model: {draft_model or 'None'}")
+    print(f"Logits Classifier: {'On' if logits_classifier else 'Off'}")
     print()
     
     # Load queries
@@ -55,24 +75,37 @@ def benchmark_ambiguity(
     print(f"Loaded {len(queries)} queries")
     print()
     
+    # Serving engines schedule their own batches, so hand them every query at once
+    if backend in SERVING_BACKENDS:
+        batch_size = max(len(queries), 1)
+    
     # Initialize agent
-    agent = AmbiguityAgent(model_id)
+    agent = AmbiguityAgent(model_id, quantization=quantization, backend=backend)
+    if prompt_cache:
+        agent.enable_prompt_cache(semantic_threshold=semantic_threshold)
+    # Assisted generation decodes one sequence at a time
+    if draft_model and agent.enable_speculative_decoding(draft_model):
+        batch_size = 1
+    if logits_classifier:
+        logits_classifier = agent.enable_logits_classification()
     
     # Process queries
     results = []
     start_time = time.time()
     
-    for idx, query in enumerate(queries, 1):
-        print(f"Processing [{idx}/{len(queries)}]: {query[:60]}...")
-        
-        stage_start = time.time()
-        result = agent.process(query, custom_instruction_key=custom_instruction_key)
-        stage_time = time.time() - stage_start
-        
-        result["processing_time"] = stage_time
-        results.append(result)
-        
-        print(f"  Classification: {result['classification']} ({stage_time:.2f}s)")
+    batch_stream = agent.process_stream(
+        queries,
+        batch_size,
+        custom_instruction_key=custom_instruction_key
+    )
+    # Per-query details go to the results JSON; the loop only advances a throttled bar
+    with tqdm(total=len(queries), desc="Queries", unit="query", mininterval=1.0) as progress:
+        for batch, batch_results, stage_time in batch_stream:
+            # Batch wall time is split evenly across the queries it served
+            for result in batch_results:
+                result["processing_time"] = stage_time / len(batch)
+            results.extend(batch_results)
+            progress.update(len(batch))
     
     total_time = time.time() - start_time
     
@@ -87,6 +120,12 @@ def benchmark_ambiguity(
         "total_time": total_time,
         "avg_time_per_query": total_time / len(queries),
         "custom_instruction": custom_instruction_key,
+        "batch_size": batch_size,
+        "quantization": quantization,
+        "backend": backend,
+        "draft_model": draft_model,
+        "logits_classifier": logits_classifier,
+        "prompt_cache_hits": agent.prompt_cache.hits if prompt_cache else None,
         "timestamp": timestamp,
         "results": results
     }
@@ -118,4 +157,39 @@ def benchmark_ambiguity(
 
 
 if __name__ == "__main__":
-    benchmark_ambiguity()
+    parser = argparse.ArgumentParser(description="Benchmark AmbiguityAgent")
+    parser.add_argument("--model", default="TinyLlama/TinyLlama-1.1B-Chat-v1.0", help="HuggingFace model ID")
+    parser.add_argument("--queries-file", default="./test_data/ambiguity_intent.csv", help="Path to test queries CSV")
+    parser.add_argument("--output-dir", default="./results", help="Directory to save results")
+    parser.add_argument("--instruction", default=None, help="Custom instruction key")
+    parser.add_argument("--batch-size", type=int, default=32, help="Queries per batched generate call")
+    parser.add_argument("--quant", choices=QUANTIZATION_MODES, default="auto",
+                        help="Weight precision: fp16/bf16 on GPU, bf16, bitsandbytes int8/int4, "
+                             "AWQ int4 checkpoints, or fp8 (serving backends)")
+    parser.add_argument("--backend", choices=BACKENDS, default="eager",
+                        help="Run the model eagerly, through torch.compile, with vLLM in-process, or via a vLLM/SGLang server")
+    parser.add_argument("--prompt-cache", action="store_true",
+                        help="Reuse cached responses for repeated prompts (cache hits skip generation)")
+    parser.add_argument("--semantic-threshold", type=float, default=None,
+                        help="Cosine similarity for near-duplicate cache hits, e.g. 0.97")
+    parser.add_argument("--draft-model", default=None,
+                        help="Draft model for speculative decoding, e.g. TinyLlama/TinyLlama-1.1B-Chat-v1.0 "
+                             "(used only when the target has at least 7B parameters)")
+    parser.add_argument("--logits-classifier", action="store_true",
+                        help="Classify from the Ambiguous/Clear next-token logits of one forward pass "
+                             "instead of generating an assessment")
+    args = parser.parse_args()
+    
+    benchmark_ambiguity(
+        model_id=args.model,
+        queries_file=args.queries_file,
+        output_dir=args.output_dir,
+        custom_instruction_key=args.instruction,
+        batch_size=args.batch_size,
+        quantization=args.quant,
+        backend=args.backend,
+        prompt_cache=args.prompt_cache,
+        semantic_threshold=args.semantic_threshold,
+        draft_model=args.draft_model,
+        logits_classifier=args.logits_classifier
+    )
@@ -2,30 +2,62 @@
 Benchmark for NLQ→SQL Pipeline (NLQAgent → SQLAgent)
 """
 
+import argparse
 import json
+import re
+import string
 import time
 from datetime import datetime
 from pathlib import Path
-from typing import List, Dict
+from typing import List, Dict, FrozenSet
 
-from utils import NLQAgent, SQLAgent, NLQSQLPipeline
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from utils import NLQAgent, SQLAgent, NLQSQLPipeline, load_model
+from utils.agent_server import AgentClient, RemoteAgent
 from utils.schema_context import get_schema_context
+from utils.three_agents import QUANTIZATION_MODES, BACKENDS, SERVING_BACKENDS
+
+
+# SQL is compared as a bag of lowercased word tokens; punctuation becomes a
+# separator so "t.id" and "COUNT(*)" split into their identifiers
+_PUNCTUATION_TABLE = str.maketrans(string.punctuation, " " * len(string.punctuation))
+_TOKEN_RE = re.compile(r"\w+")
 
 
 def load_queries(csv_path: str) -> List[Dict]:
-    """Load queries from CSV with expected SQL"""
-    import csv
-    queries = []
-    with open(csv_path, 'r', encoding='utf-8') as f:
-        reader = csv.reader(f)
-        next(reader)  # Skip header
-        for row in reader:
-            if row and len(row) >= 2:
-                queries.append({
-                    "natural_language": row[0],
-                    "expected_sql": row[1] if len(row) > 1 else ""
-                })
-    return queries
+    """Load queries (first column) with expected SQL (second column) from CSV"""
+    # Read everything as text so values like "NULL" or "NA" are not turned into NaN;
+    # the C parser is used because expected SQL cells span multiple lines
+    df = pd.read_csv(csv_path, dtype=str, keep_default_na=False)
+    if df.shape[1] < 2:
+        return []
+    
+    return [
+        {
+            "natural_language": natural_language,
+            "expected_sql": expected_sql,
+            # Expected SQL never changes between runs, so tokenize it once here
+            "_expected_tokens": sql_tokens(expected_sql)
+        }
+        for natural_language, expected_sql in zip(df.iloc[:, 0], df.iloc[:, 1])
+    ]
+
+
+def sql_tokens(sql: str) -> FrozenSet[str]:
+    """Normalized token set used to compare generated and expected SQL"""
+    return frozenset(_TOKEN_RE.findall(sql.translate(_PUNCTUATION_TABLE).lower()))
+
+
+def sql_similarity(predicted_sql: str, expected_tokens: FrozenSet[str]) -> float:
+    """Jaccard overlap between generated SQL tokens and precomputed expected tokens"""
+    predicted_tokens = sql_tokens(predicted_sql)
+    union = predicted_tokens | expected_tokens
+    if not union:
+        return 0.0
+    return len(predicted_tokens & expected_tokens) / len(union)
 
 
 def benchmark_nlq_sql_pipeline(
@@ -33,7 +65,15 @@ def benchmark_nlq_sql_pipeline(
     queries_file: str = "./test_data/nl_to_sql.csv",
     output_dir: str = "./results",
     nlq_instruction_key: str = None,
-    sql_instruction_key: str = None
+    sql_instruction_key: str = None,
+    batch_size: int = 32,
+    quantization: str = "auto",
+    backend: str = "eager",
+    prompt_cache: bool = False,
+    semantic_threshold: float = None,
+    draft_model: str = None,
+    local_files_only: bool = False,
+    agent_server: str = None
 ):
     """
     Benchmark NLQ→SQL Pipeline on test queries
@@ -44,6 +84,15 @@ def benchmark_nlq_sql_pipeline(
         output_dir: Directory to save results
         nlq_instruction_key: Optional custom instruction for NLQ stage
         sql_instruction_key: Optional custom instruction for SQL stage
+        batch_size: Number of queries per batched generate call
+        quantization: Weight precision/quantization mode (see QUANTIZATION_MODES)
+        backend: Inference backend (see BACKENDS)
+        prompt_cache: Serve repeated prompts from the persistent prompt cache
+        semantic_threshold: Optional similarity for near-duplicate cache hits
+        draft_model: Optional small model for speculative decoding (targets >= 7B only)
+        local_files_only: Load the model from the local cache only (already downloaded)
+        agent_server: Socket of a running agent server (utils/agent_server.py) that
+            already holds the model; generation is delegated to it instead of loading here
     """
     output_dir = Path(output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
@@ -55,6 +104,12 @@ def benchmark_nlq_sql_pipeline(
     print(f"Queries: {queries_file}")
     print(f"NLQ Instruction: {nlq_instruction_key or 'Default'}")
     print(f"SQL Instruction: {sql_instruction_key or 'Default'}")
+    print(f"Batch Size: {batch_size}")
+    print(f"Quantization: {quantization}")
+    print(f"Backend: {backend}")
+    print(f"Prompt Cache: {'On' if prompt_cache else 'Off'}")
+    print(f"Draft Model: {draft_model or 'None'}")
+    print(f"Agent Server: {agent_server or 'None'}")
     print()
     
     # Load queries
@@ -62,39 +117,81 @@ def benchmark_nlq_sql_pipeline(
     print(f"Loaded {len(query_pairs)} query pairs")
     print()
     
+    # Serving engines schedule their own batches, so hand them every query at once
+    if backend in SERVING_BACKENDS:
+        batch_size = max(len(query_pairs), 1)
+    
     # Load schema context
     schema_context = get_schema_context()
     
-    # Initialize agents
-    nlq_agent = NLQAgent(model_id)
-    sql_agent = SQLAgent(model_id)
+    client = None
+    if agent_server:
+        # The server process keeps the model loaded between runs
+        if prompt_cache or draft_model:
+            raise ValueError("prompt_cache and draft_model are not supported with agent_server")
+        client = AgentClient(agent_server)
+        nlq_agent = RemoteAgent(client, "nlq_refinement")
+        sql_agent = RemoteAgent(client, "sql_generation")
+    else:
+        # Initialize agents - both stages share one loaded copy of the model
+        model_and_tokenizer = load_model(model_id, quantization=quantization, backend=backend,
+                                         local_files_only=local_files_only)
+        nlq_agent = NLQAgent(model_id, quantization=quantization, backend=backend,
+                             model_and_tokenizer=model_and_tokenizer)
+        sql_agent = SQLAgent(model_id, quantization=quantization, backend=backend,
+                             model_and_tokenizer=model_and_tokenizer)
+    if prompt_cache:
+        nlq_agent.enable_prompt_cache(semantic_threshold=semantic_threshold)
+        sql_agent.enable_prompt_cache(semantic_threshold=semantic_threshold)
+    # Assisted generation decodes one sequence at a time
+    if draft_model and all([nlq_agent.enable_speculative_decoding(draft_model),
+                            sql_agent.enable_speculative_decoding(draft_model)]):
+        batch_size = 1
     pipeline = NLQSQLPipeline(nlq_agent, sql_agent, schema_context=schema_context)
     
-    # Process queries
-    results = []
+    # Process queries - repeated queries are generated once and shared by every row
+    queries = [pair["natural_language"] for pair in query_pairs]
+    unique_queries = list(dict.fromkeys(queries))
+    if len(unique_queries) < len(queries):
+        print(f"Generating {len(unique_queries)} unique queries ({len(queries) - len(unique_queries)} duplicates)")
+    generated: Dict[str, Dict] = {}
     start_time = time.time()
     
-    for idx, pair in enumerate(query_pairs, 1):
-        print(f"Processing [{idx}/{len(query_pairs)}]: {pair['natural_language'][:60]}...")
-        
-        stage_start = time.time()
-        result = pipeline.execute(
-            pair["natural_language"],
-            nlq_instruction_key=nlq_instruction_key,
-            sql_instruction_key=sql_instruction_key
-        )
-        stage_time = time.time() - stage_start
-        
-        result["expected_sql"] = pair.get("expected_sql", "")
-        result["processing_time"] = stage_time
-        results.append(result)
-        
-        print(f"  Refined: {result['refined_query'][:50]}...")
-        print(f"  SQL: {result['sql'][:50]}...")
-        print(f"  Time: {stage_time:.2f}s")
+    batch_stream = pipeline.execute_stream(
+        unique_queries,
+        batch_size,
+        nlq_instruction_key=nlq_instruction_key,
+        sql_instruction_key=sql_instruction_key
+    )
+    # Per-query details go to the results JSON; the loop only advances a throttled bar
+    with tqdm(total=len(unique_queries), desc="Queries", unit="query", mininterval=1.0) as progress:
+        for batch, batch_results, stage_time in batch_stream:
+            # Batch wall time is split evenly across the queries it served
+            for query, result in zip(batch, batch_results):
+                result["processing_time"] = stage_time / len(batch)
+                generated[query] = result
+            progress.update(len(batch))
     
     total_time = time.time() - start_time
     
+    results = [
+        {**generated[pair["natural_language"]], "expected_sql": pair.get("expected_sql", "")}
+        for pair in query_pairs
+    ]
+    if client is not None:
+        client.close()
+    
+    # Score every generated SQL in one pass, outside the timed generation loop
+    similarities = np.fromiter(
+        (sql_similarity(result["sql"], pair["_expected_tokens"])
+         for result, pair in zip(results, query_pairs)),
+        dtype=float,
+        count=len(results)
+    )
+    for result, similarity in zip(results, similarities):
+        result["sql_similarity"] = float(similarity)
+    avg_similarity = float(similarities.mean()) if len(similarities) else 0.0
+    
     # Save results
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     results_file = output_dir / f"nlq_sql_pipeline_{timestamp}.json"
@@ -105,8 +202,17 @@ def benchmark_nlq_sql_pipeline(
         "total_queries": len(query_pairs),
         "total_time": total_time,
         "avg_time_per_query": total_time / len(query_pairs),
+        "avg_sql_similarity": avg_similarity,
         "nlq_instruction": nlq_instruction_key,
         "sql_instruction": sql_instruction_key,
+        "batch_size": batch_size,
+        "quantization": quantization,
+        "backend": backend,
+        "draft_model": draft_model,
+        "agent_server": agent_server,
+        "prompt_cache_hits": (
+            nlq_agent.prompt_cache.hits + sql_agent.prompt_cache.hits if prompt_cache else None
+        ),
         "timestamp": timestamp,
         "results": results
     }
@@ -121,10 +227,48 @@ def benchmark_nlq_sql_pipeline(
     print(f"Total queries processed: {len(query_pairs)}")
     print(f"Total time: {total_time:.2f}s")
     print(f"Average time per query: {total_time / len(query_pairs):.2f}s")
+    print(f"Average SQL similarity: {avg_similarity:.3f}")
     print()
     print(f"Results saved to: {results_file}")
     print()
 
 
 if __name__ == "__main__":
-    benchmark_nlq_sql_pipeline()
+    parser = argparse.ArgumentParser(description="Benchmark NLQ→SQL pipeline")
+    parser.add_argument("--model", default="TinyLlama/TinyLlama-1.1B-Chat-v1.0", help="HuggingFace model ID")
+    parser.add_argument("--queries-file", default="./test_data/nl_to_sql.csv", help="Path to test queries CSV")
+    parser.add_argument("--output-dir", default="./results", help="Directory to save results")
+    parser.add_argument("--nlq-instruction", default=None, help="Custom instruction key for the NLQ stage")
+    parser.add_argument("--sql-instruction", default=None, help="Custom instruction key for the SQL stage")
+    parser.add_argument("--batch-size", type=int, default=32, help="Queries per batched generate call")
+    parser.add_argument("--quant", choices=QUANTIZATION_MODES, default="auto",
+                        help="Weight precision: fp16/bf16 on GPU, bf16, bitsandbytes int8/int4, "
+                             "AWQ int4 checkpoints, or fp8 (serving backends)")
+    parser.add_argument("--backend", choices=BACKENDS, default="eager",
+                        help="Run the model eagerly, through torch.compile, with vLLM in-process, or via a vLLM/SGLang server")
+    parser.add_argument("--prompt-cache", action="store_true",
+                        help="Reuse cached responses for repeated prompts (cache hits skip generation)")
+    parser.add_argument("--semantic-threshold", type=float, default=None,
+                        help="Cosine similarity for near-duplicate cache hits, e.g. 0.97")
+    parser.add_argument("--draft-model", default=None,
+                        help="Draft model for speculative decoding, e.g. TinyLlama/TinyLlama-1.1B-Chat-v1.0 "
+                             "(used only when the target has at least 7B parameters)")
+    parser.add_argument("--agent-server", default=None,
+                        help="Socket of a running agent server holding the model "
+                             "(start one with: python -m utils.agent_server --model ... --address ...)")
+    args = parser.parse_args()
+    
+    benchmark_nlq_sql_pipeline(
+        model_id=args.model,
+        queries_file=args.queries_file,
+        output_dir=args.output_dir,
+        nlq_instruction_key=args.nlq_instruction,
+        sql_instruction_key=args.sql_instruction,
+        batch_size=args.batch_size,
+        quantization=args.quant,
+        backend=args.backend,
+        prompt_cache=args.prompt_cache,
+        semantic_threshold=args.semantic_threshold,
+        draft_model=args.draft_model,
+        agent_server=args.agent_server
+    )
@@ -3,13 +3,26 @@ Multi-Model Benchmarking Script
 Runs NLQ→SQL Pipeline benchmarks on multiple models from a configuration list
 """
 
+import argparse
 import json
+import multiprocessing
+import os
+import sys
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime
 from pathlib import Path
-from typing import List, Dict
-import csv
+from typing import List, Dict, Optional, Set, Tuple
+
+import orjson
+import pyarrow as pa
+import pyarrow.parquet as pq
+import torch
+
 from benchmark_nlq_sql_pipeline import benchmark_nlq_sql_pipeline
+from utils import clear_model_cache, download_model, load_model
+from utils.agent_server import ensure_server, evict_servers, socket_path
+from utils.three_agents import SERVING_BACKENDS
 
 
 class BenchmarkConfig:
@@ -21,6 +34,7 @@ class BenchmarkConfig:
         self.models = []
         self.benchmark_dataset = None
         self.output_dir = "./results"
+        self.batch_size = 32
         self.load_config()
     
     def load_config(self):
@@ -28,9 +42,11 @@ class BenchmarkConfig:
         if Path(self.config_file).exists():
             with open(self.config_file, 'r') as f:
                 config = json.load(f)
-                self.models = config.get('models', [])
+                # Disabled entries are dropped here so nothing downstream sees them
+                self.models = [m for m in config.get('models', []) if m.get('enabled', True)]
                 self.benchmark_dataset = config.get('benchmark_dataset', 'test_data/benchmark_queries.csv')
                 self.output_dir = config.get('output_dir', './results')
+                self.batch_size = config.get('batch_size', 32)
         else:
             self.create_default_config()
     
@@ -41,50 +57,159 @@ class BenchmarkConfig:
                 {
                     "model_id": "TinyLlama/TinyLlama-1.1B-Chat-v1.0",
                     "enabled": True,
+                    "quantization": "auto",
                     "nlq_instruction_key": None,
                     "sql_instruction_key": None
                 },
                 {
                     "model_id": "infly/OpenCoder-8B-Instruct",
                     "enabled": True,
+                    "quantization": "auto",
                     "nlq_instruction_key": None,
                     "sql_instruction_key": None
                 },
                 {
                     "model_id": "meta-llama/Llama-3.1-8B-Instruct",
                     "enabled": True,
+                    "quantization": "auto",
                     "nlq_instruction_key": None,
                     "sql_instruction_key": None
                 },
                 {
                     "model_id": "Qwen/Qwen2.5-7B-Instruct",
                     "enabled": True,
+                    "quantization": "auto",
                     "nlq_instruction_key": None,
                     "sql_instruction_key": None
                 },
                 {
                     "model_id": "mistralai/Mistral-7B-Instruct-v0.3",
                     "enabled": True,
+                    "quantization": "auto",
                     "nlq_instruction_key": None,
                     "sql_instruction_key": None
                 }
             ],
             "benchmark_dataset": "test_data/benchmark_queries.csv",
             "output_dir": "./results",
+            "batch_size": 32,
             "notes": "Edit this file to enable/disable models or customize instructions"
         }
         
-        with open(self.config_file, 'w') as f:
-            json.dump(config, f, indent=2)
+        _write_json_atomic(Path(self.config_file), config)
         
-        self.models = config['models']
+        self.models = [m for m in config['models'] if m.get('enabled', True)]
         self.benchmark_dataset = config['benchmark_dataset']
         self.output_dir = config['output_dir']
+        self.batch_size = config['batch_size']
         
         print(f"Created default configuration: {self.config_file}")
         print("Edit the file to enable/disable models or add custom instructions")
 
 
+def _write_json_atomic(path: Path, data: Dict):
+    """Write indented JSON to a temporary file and move it into place"""
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, 'wb') as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+    os.replace(tmp_path, path)
+
+
+def _init_worker(gpu_ids):
+    """Pin a benchmark worker process to one GPU before it initializes CUDA"""
+    gpu_id = gpu_ids.get()
+    if gpu_id is not None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(gpu_id)
+
+
+def _prefetch(model_config: Dict, load: bool = False):
+    """Download a model and, optionally, load it into the process-wide model cache"""
+    model_id = model_config['model_id']
+    download_model(model_id)
+    if not load:
+        return
+    load_model(
+        model_id,
+        quantization=model_config.get('quantization', 'auto'),
+        backend=model_config.get('backend', 'eager'),
+        local_files_only=True
+    )
+
+
+def _run_one(model_config: Dict, dataset: str, output_dir: str, batch_size: int = 32,
+             local_files_only: bool = False, keep_loaded: Tuple[str, ...] = (),
+             agent_server_dir: Optional[str] = None,
+             agent_server_budget: Optional[float] = None) -> Dict:
+    """
+    Benchmark one model configuration.
+    
+    Top-level so it can be shipped to worker processes. A "batch_size" in
+    the model configuration overrides the run-wide batch size; optional
+    "quantization" and "backend" entries select the weight format (see
+    QUANTIZATION_MODES) and inference backend (see BACKENDS).
+    
+    Args:
+        keep_loaded: Model IDs (e.g. one being preloaded) that stay in the model cache
+        agent_server_dir: Directory of agent server sockets; the model is served by a
+            long-lived agent server (started on first use) instead of loaded here
+        agent_server_budget: GB of GPU memory other models' agent servers may keep
+            resident; by default they are shut down before this model's server starts
+    
+    Returns:
+        Result dictionary with status "completed" or "failed"
+    """
+    model_id = model_config['model_id']
+    quantization = model_config.get('quantization', 'auto')
+    backend = model_config.get('backend', 'eager')
+    
+    # Free the previous model; repeated entries for the same model reuse the loaded copy
+    clear_model_cache(keep=(model_id, *keep_loaded))
+    
+    try:
+        model_start = time.time()
+        
+        agent_server = None
+        if agent_server_dir:
+            address = socket_path(agent_server_dir, model_id, quantization, backend)
+            # Earlier models' servers would otherwise keep their weights on this GPU
+            evict_servers(agent_server_dir, address,
+                          agent_server_budget * 1024 ** 3 if agent_server_budget is not None else None)
+            agent_server = ensure_server(model_id, address, quantization=quantization, backend=backend)
+        
+        # Run the benchmark
+        benchmark_nlq_sql_pipeline(
+            model_id=model_id,
+            queries_file=dataset,
+            output_dir=output_dir,
+            nlq_instruction_key=model_config.get('nlq_instruction_key'),
+            sql_instruction_key=model_config.get('sql_instruction_key'),
+            batch_size=model_config.get('batch_size', batch_size),
+            quantization=quantization,
+            backend=backend,
+            local_files_only=local_files_only,
+            agent_server=agent_server
+        )
+        
+        model_time = time.time() - model_start
+        
+        print(f"✅ {model_id} completed in {model_time:.2f}s\n")
+        return {
+            "model": model_id,
+            "status": "completed",
+            "time_taken": model_time,
+            "nlq_instruction": model_config.get('nlq_instruction_key'),
+            "sql_instruction": model_config.get('sql_instruction_key')
+        }
+        
+    except Exception as e:
+        print(f"❌ Error benchmarking {model_id}: {str(e)}\n")
+        return {
+            "model": model_id,
+            "status": "failed",
+            "error": str(e)
+        }
+
+
 class MultiModelBenchmark:
     """Run benchmarks across multiple models"""
     
@@ -95,15 +220,78 @@ class MultiModelBenchmark:
             "models": [],
             "summary": {}
         }
+        self._results_log = None
+        # Single background writer so result logging never blocks the benchmark loop
+        self._writer = ThreadPoolExecutor(max_workers=1)
+    
+    def _log_result(self, result: Dict):
+        """Append one model result as a JSON line, written in the background"""
+        if self._results_log is None:
+            output_dir = Path(self.config.output_dir)
+            output_dir.mkdir(parents=True, exist_ok=True)
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            self._results_log = open(output_dir / f"multi_model_benchmark_{timestamp}.jsonl", 'wb')
+        
+        line = orjson.dumps(result) + b"\n"
+        self._writer.submit(self._write_line, self._results_log, line)
+    
+    @staticmethod
+    def _write_line(f, line: bytes):
+        f.write(line)
+        f.flush()
+    
+    def warmup_models(self, models: List[Dict]) -> Set[str]:
+        """
+        Download every model up front, before any benchmark starts
+        
+        Returns:
+            IDs of the models now available locally
+        """
+        print(f"Downloading {len(models)} models before benchmarking...")
+        downloaded = set()
+        for model_config in models:
+            model_id = model_config['model_id']
+            try:
+                download_model(model_id, max_workers=8)
+                downloaded.add(model_id)
+            except Exception as e:
+                print(f"⚠️  Download failed for {model_id}, downloading on load: {str(e)}")
+        return downloaded
     
-    def run_all_benchmarks(self):
-        """Run benchmarks for all enabled models"""
-        enabled_models = [m for m in self.config.models if m.get('enabled', True)]
+    def run_all_benchmarks(self, max_parallel_models: Optional[int] = None,
+                           benchmark_chunk_size: Optional[int] = None,
+                           preload_next: bool = False, warmup: bool = False,
+                           agent_server_dir: Optional[str] = None,
+                           agent_server_budget: Optional[float] = None):
+        """
+        Run benchmarks for all enabled models
+        
+        Args:
+            max_parallel_models: Models benchmarked at once, each in its own
+                process pinned to one GPU (defaults to one per visible GPU)
+            benchmark_chunk_size: Queries per batched generate call within a model
+                (defaults to the configuration's batch_size)
+            preload_next: When running sequentially, load the next model while
+                the current one is benchmarked
+            warmup: Download every enabled model before the first benchmark
+            agent_server_dir: Serve each model from a long-lived agent server whose
+                socket lives in this directory, so later runs skip the model load
+            agent_server_budget: GB of GPU memory earlier models' agent servers may
+                keep resident (default: shut them down before the next model starts)
+        """
+        enabled_models = self.config.models
         
         if not enabled_models:
             print("❌ No models enabled in configuration!")
             return
         
+        if benchmark_chunk_size is None:
+            benchmark_chunk_size = self.config.batch_size
+        
+        gpu_count = torch.cuda.device_count()
+        if max_parallel_models is None:
+            max_parallel_models = max(1, min(len(enabled_models), gpu_count))
+        
         print("\n" + "=" * 70)
         print("MULTI-MODEL BENCHMARK RUNNER")
         print("=" * 70)
@@ -111,52 +299,30 @@ class MultiModelBenchmark:
         print(f"Benchmark Dataset: {self.config.benchmark_dataset}")
         print(f"Output Directory: {self.config.output_dir}")
         print(f"Total Models to Run: {len(enabled_models)}")
+        print(f"Parallel Models: {max_parallel_models}")
+        print(f"Batch Size: {benchmark_chunk_size}")
         print("=" * 70 + "\n")
         
-        model_results = []
         total_start = time.time()
         
-        for idx, model_config in enumerate(enabled_models, 1):
-            model_id = model_config['model_id']
-            print(f"\n[{idx}/{len(enabled_models)}] Running benchmark for: {model_id}")
-            print("-" * 70)
-            
-            try:
-                model_start = time.time()
-                
-                # Run the benchmark
-                benchmark_nlq_sql_pipeline(
-                    model_id=model_id,
-                    queries_file=self.config.benchmark_dataset,
-                    output_dir=self.config.output_dir,
-                    nlq_instruction_key=model_config.get('nlq_instruction_key'),
-                    sql_instruction_key=model_config.get('sql_instruction_key')
-                )
-                
-                model_time = time.time() - model_start
-                
-                result = {
-                    "model": model_id,
-                    "status": "completed",
-                    "time_taken": model_time,
-                    "nlq_instruction": model_config.get('nlq_instruction_key'),
-                    "sql_instruction": model_config.get('sql_instruction_key')
-                }
-                model_results.append(result)
-                
-                print(f"✅ Completed in {model_time:.2f}s\n")
-                
-            except Exception as e:
-                print(f"❌ Error benchmarking {model_id}: {str(e)}\n")
-                result = {
-                    "model": model_id,
-                    "status": "failed",
-                    "error": str(e)
-                }
-                model_results.append(result)
+        local_models = self.warmup_models(enabled_models) if warmup else set()
+        
+        if max_parallel_models > 1:
+            model_results = self._run_parallel(enabled_models, max_parallel_models,
+                                               gpu_count, benchmark_chunk_size, local_models,
+                                               agent_server_dir, agent_server_budget)
+        else:
+            model_results = self._run_sequential(enabled_models, benchmark_chunk_size,
+                                                 preload_next, local_models, agent_server_dir,
+                                                 agent_server_budget)
         
         total_time = time.time() - total_start
         
+        # Wait for pending result lines before writing the summary
+        self._writer.shutdown(wait=True)
+        if self._results_log is not None:
+            self._results_log.close()
+        
         # Save summary
         self.results['end_time'] = datetime.now().isoformat()
         self.results['models'] = model_results
@@ -166,53 +332,203 @@ class MultiModelBenchmark:
         self.save_summary()
         self.print_summary(model_results, total_time)
     
+    def _run_sequential(self, enabled_models: List[Dict], benchmark_chunk_size: int,
+                        preload_next: bool = False,
+                        local_models: Set[str] = frozenset(),
+                        agent_server_dir: Optional[str] = None,
+                        agent_server_budget: Optional[float] = None) -> List[Dict]:
+        """
+        Benchmark models one after another in this process
+        
+        Args:
+            enabled_models: Model configurations to run
+            benchmark_chunk_size: Queries per batched generate call within a model
+            preload_next: Also load the next model while the current one runs
+                (needs memory for both); otherwise only its files are fetched
+            local_models: IDs of models already downloaded by warmup_models
+            agent_server_dir: Directory of agent server sockets (see _run_one)
+            agent_server_budget: GB earlier agent servers may keep resident (see _run_one)
+        """
+        model_results = []
+        
+        # Downloads (and optionally loads) of upcoming models run in the background
+        # while the current one is benchmarked
+        prefetcher = ThreadPoolExecutor(max_workers=2)
+        prefetches = {}
+        
+        for idx, model_config in enumerate(enabled_models, 1):
+            model_id = model_config['model_id']
+            print(f"\n[{idx}/{len(enabled_models)}] Running benchmark for: {model_id}")
+            print("-" * 70)
+            
+            keep_loaded = ()
+            if idx < len(enabled_models):
+                next_config = enabled_models[idx]
+                next_model_id = next_config['model_id']
+                # A second serving engine would not fit next to the running one, and
+                # models behind an agent server are loaded by the server
+                preload = (preload_next and not agent_server_dir
+                           and next_config.get('backend', 'eager') not in SERVING_BACKENDS)
+                if next_model_id not in prefetches and (preload or next_model_id not in local_models):
+                    prefetches[next_model_id] = prefetcher.submit(_prefetch, next_config, preload)
+                if preload:
+                    keep_loaded = (next_model_id,)
+            
+            # Once the prefetch has landed, loading never touches the network
+            prefetched = model_id in local_models
+            if model_id in prefetches:
+                try:
+                    prefetches[model_id].result()
+                    prefetched = True
+                except Exception as e:
+                    print(f"⚠️  Prefetch failed for {model_id}, downloading on load: {str(e)}")
+            
+            result = _run_one(model_config, self.config.benchmark_dataset, self.config.output_dir,
+                              benchmark_chunk_size, local_files_only=prefetched,
+                              keep_loaded=keep_loaded, agent_server_dir=agent_server_dir,
+                              agent_server_budget=agent_server_budget)
+            model_results.append(result)
+            self._log_result(result)
+        
+        prefetcher.shutdown(wait=False)
+        return model_results
+    
+    def _run_parallel(self, enabled_models: List[Dict], max_parallel_models: int,
+                      gpu_count: int, benchmark_chunk_size: int,
+                      local_models: Set[str] = frozenset(),
+                      agent_server_dir: Optional[str] = None,
+                      agent_server_budget: Optional[float] = None) -> List[Dict]:
+        """Benchmark models concurrently, one worker process per GPU"""
+        # Spawned workers start without an inherited CUDA context
+        ctx = multiprocessing.get_context("spawn")
+        gpu_ids = ctx.Queue()
+        for worker in range(max_parallel_models):
+            gpu_ids.put(worker % gpu_count if gpu_count else None)
+        
+        model_results: List[Optional[Dict]] = [None] * len(enabled_models)
+        
+        with ProcessPoolExecutor(max_workers=max_parallel_models, mp_context=ctx,
+                                 initializer=_init_worker, initargs=(gpu_ids,)) as ex:
+            futures = {
+                ex.submit(_run_one, model_config, self.config.benchmark_dataset,
+                          self.config.output_dir, benchmark_chunk_size,
+                          model_config['model_id'] in local_models,
+                          agent_server_dir=agent_server_dir,
+                          agent_server_budget=agent_server_budget): idx
+                for idx, model_config in enumerate(enabled_models)
+            }
+            
+            for done, future in enumerate(as_completed(futures), 1):
+                idx = futures[future]
+                model_id = enabled_models[idx]['model_id']
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # The worker process itself died (e.g. out of host memory)
+                    print(f"❌ Error benchmarking {model_id}: {str(e)}\n")
+                    result = {"model": model_id, "status": "failed", "error": str(e)}
+                
+                print(f"[{done}/{len(enabled_models)}] Finished: {model_id}")
+                model_results[idx] = result
+                self._log_result(result)
+        
+        return model_results
+    
     def save_summary(self):
-        """Save benchmark summary to JSON"""
+        """
+        Save the per-model results to Parquet and the full summary to JSON
+        
+        The JSON file is deprecated and kept only for existing readers; load
+        the Parquet file (one row per model run) for analysis instead.
+        """
         output_dir = Path(self.config.output_dir)
         output_dir.mkdir(parents=True, exist_ok=True)
         
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         summary_file = output_dir / f"multi_model_benchmark_summary_{timestamp}.json"
+        parquet_file = summary_file.with_suffix(".parquet")
         
-        with open(summary_file, 'w') as f:
-            json.dump(self.results, f, indent=2)
+        # Failed runs carry different keys than completed ones, so take the union
+        model_results = self.results['models']
+        columns = dict.fromkeys(key for result in model_results for key in result)
+        table = pa.table({key: [result.get(key) for result in model_results] for key in columns})
+        pq.write_table(table, parquet_file, compression="zstd")
         
-        print(f"📊 Summary saved to: {summary_file}")
+        _write_json_atomic(summary_file, self.results)
+        
+        print(f"📊 Summary saved to: {parquet_file} (deprecated JSON copy: {summary_file})")
     
     def print_summary(self, model_results: List[Dict], total_time: float):
         """Print benchmark summary"""
-        print("\n" + "=" * 70)
-        print("BENCHMARK SUMMARY")
-        print("=" * 70)
-        print(f"Dataset: {self.config.benchmark_dataset}")
-        print(f"Total Time: {total_time:.2f}s ({total_time/60:.2f}m)")
-        print()
-        
-        print("MODEL RESULTS:")
+        # Built up front and written in one call so worker output cannot interleave
+        lines = [
+            "",
+            "=" * 70,
+            "BENCHMARK SUMMARY",
+            "=" * 70,
+            f"Dataset: {self.config.benchmark_dataset}",
+            f"Total Time: {total_time:.2f}s ({total_time/60:.2f}m)",
+            "",
+            "MODEL RESULTS:"
+        ]
         for result in model_results:
             status = "✅" if result['status'] == 'completed' else "❌"
             model_short = result['model'].split('/')[-1]
             
             if result['status'] == 'completed':
                 time_str = f"{result['time_taken']:.2f}s"
-                print(f"  {status} {model_short:40} - {time_str}")
+                lines.append(f"  {status} {model_short:40} - {time_str}")
             else:
                 error = result.get('error', 'Unknown error')[:50]
-                print(f"  {status} {model_short:40} - Error: {error}")
+                lines.append(f"  {status} {model_short:40} - Error: {error}")
         
         completed = sum(1 for r in model_results if r['status'] == 'completed')
-        print(f"\nCompleted: {completed}/{len(model_results)}")
-        print("=" * 70 + "\n")
+        lines += [
+            "",
+            f"Completed: {completed}/{len(model_results)}",
+            "=" * 70,
+            "",
+            ""
+        ]
+        sys.stdout.write("\n".join(lines))
+        sys.stdout.flush()
 
 
 def main():
     """Main entry point"""
-    import sys
-    
-    config_file = sys.argv[1] if len(sys.argv) > 1 else "benchmark_config.json"
+    parser = argparse.ArgumentParser(description="Run NLQ→SQL pipeline benchmarks on multiple models")
+    parser.add_argument("config_file", nargs="?", default="benchmark_config.json",
+                        help="Benchmark configuration JSON")
+    parser.add_argument("--max-parallel-models", type=int, default=None,
+                        help="Models benchmarked concurrently, one process per GPU "
+                             "(default: number of visible GPUs)")
+    parser.add_argument("--benchmark-chunk-size", type=int, default=None,
+                        help="Queries per batched generate call within each model "
+                             "(default: batch_size from the configuration, 32)")
+    parser.add_argument("--preload-next", action="store_true",
+                        help="Load the next model while the current one is benchmarked "
+                             "(needs GPU memory for two models)")
+    parser.add_argument("--warmup-models", action="store_true",
+                        help="Download all enabled models before the first benchmark "
+                             "(uses hf_transfer when installed)")
+    parser.add_argument("--agent-servers", default=None, metavar="DIR",
+                        help="Serve each model from a long-lived agent server with its socket in DIR; "
+                             "the last model's server keeps running after the benchmark so repeated runs "
+                             "skip model loading, earlier ones are shut down when the next model starts")
+    parser.add_argument("--agent-server-budget", type=float, default=None, metavar="GB",
+                        help="With --agent-servers, GPU memory earlier models' servers may keep "
+                             "resident instead of being shut down (most recent first)")
+    args = parser.parse_args()
     
-    benchmark = MultiModelBenchmark(config_file)
-    benchmark.run_all_benchmarks()
+    benchmark = MultiModelBenchmark(args.config_file)
+    benchmark.run_all_benchmarks(
+        max_parallel_models=args.max_parallel_models,
+        benchmark_chunk_size=args.benchmark_chunk_size,
+        preload_next=args.preload_next,
+        warmup=args.warmup_models,
+        agent_server_dir=args.agent_servers,
+        agent_server_budget=args.agent_server_budget
+    )
 
 
 if __name__ == "__main__":
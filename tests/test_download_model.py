@@ -0,0 +1,59 @@
+"""download_model fetches loadable weights for safetensors and .bin-only repos"""
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from utils import three_agents
+
+
+SAFETENSORS_REPO = [
+    "config.json",
+    "model-00001-of-00002.safetensors",
+    "model-00002-of-00002.safetensors",
+    "model.safetensors.index.json",
+    "original/consolidated.00.pth",
+    "tokenizer.json",
+]
+
+BIN_ONLY_REPO = [
+    "config.json",
+    "pytorch_model-00001-of-00002.bin",
+    "pytorch_model-00002-of-00002.bin",
+    "pytorch_model.bin.index.json",
+    "tokenizer.model",
+]
+
+
+class _FakeApi:
+    def __init__(self, files):
+        self.files = files
+    
+    def list_repo_files(self, repo_id):
+        return self.files
+
+
+def _download(monkeypatch, files):
+    calls = {}
+    monkeypatch.setattr(three_agents, "HfApi", lambda: _FakeApi(files))
+    monkeypatch.setattr(three_agents, "snapshot_download", lambda **kwargs: calls.update(kwargs) or "snapshot")
+    three_agents.download_model("org/model", "./models")
+    return calls
+
+
+def test_safetensors_repo_skips_bin_weights(monkeypatch):
+    calls = _download(monkeypatch, SAFETENSORS_REPO)
+    assert "*.safetensors" in calls["allow_patterns"]
+    assert "*.bin" not in calls["allow_patterns"]
+    assert "original/*" in calls["ignore_patterns"]
+
+
+def test_bin_only_repo_downloads_bin_weights(monkeypatch):
+    calls = _download(monkeypatch, BIN_ONLY_REPO)
+    assert "*.bin" in calls["allow_patterns"]
+
+
+def test_ignored_safetensors_do_not_count_as_weights():
+    patterns = three_agents.download_allow_patterns(["config.json", "consolidated.safetensors", "pytorch_model.bin"])
+    assert "*.bin" in patterns
@@ -1,6 +1,7 @@
 """Utils module for LLM Benchmarker"""
-from .three_agents import BaseAgent, NLQAgent, SQLAgent, AmbiguityAgent
+from .three_agents import BaseAgent, NLQAgent, SQLAgent, AmbiguityAgent, load_model, download_model, clear_model_cache
 from .nlq_sql_pipeline import NLQSQLPipeline, AmbiguityPipeline
+from .orchestrator import ThreeAgentOrchestrator
 from .custom_instructions import (
     CustomInstruction,
     InstructionRegistry,
@@ -15,8 +16,12 @@ __all__ = [
     "NLQAgent",
     "SQLAgent",
     "AmbiguityAgent",
+    "load_model",
+    "download_model",
+    "clear_model_cache",
     "NLQSQLPipeline",
     "AmbiguityPipeline",
+    "ThreeAgentOrchestrator",
     "CustomInstruction",
     "InstructionRegistry",
     "get_registry",
@@ -0,0 +1,317 @@
+"""
+Long-lived agent server.
+Loads a model once and serves batch requests from other processes over a local
+socket, so repeated benchmark runs against the same model skip the load entirely.
+
+Start a server:
+    python -m utils.agent_server --model TinyLlama/TinyLlama-1.1B-Chat-v1.0 --address /tmp/tinyllama.sock
+
+Then pass the same address as --agent-server to benchmark_nlq_sql_pipeline.py,
+or use --agent-servers DIR with run_multi_model_benchmark.py to start (or reuse)
+one server per model automatically. Servers are named per model, quantization,
+backend and visible GPUs; starting one shuts down the others on the same GPUs
+unless a memory budget lets them stay resident (see evict_servers).
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import torch
+
+from .three_agents import AmbiguityAgent, NLQAgent, SQLAgent, BaseAgent, load_model, QUANTIZATION_MODES, BACKENDS
+
+
+DEFAULT_AUTHKEY = b"llm-benchmarker"
+
+AGENT_CLASSES = {
+    "ambiguity_detection": AmbiguityAgent,
+    "nlq_refinement": NLQAgent,
+    "sql_generation": SQLAgent
+}
+
+
+def serve(model_id: str, address: str, models_dir: str = "./models",
+          quantization: str = "auto", backend: str = "eager",
+          authkey: bytes = DEFAULT_AUTHKEY):
+    """
+    Load a model once and answer requests until a shutdown request arrives.
+    
+    Requests are dicts:
+        {"task": ..., "inputs": [...], "instruction": ..., "context": ...}
+            -> list of result dicts (process_batch of that task's agent)
+        {"prompts": [...], "max_tokens": N, "temperature": T}
+            -> list of generated strings
+        {"command": "info"}
+            -> {"model_id": ..., "quantization": ..., "backend": ..., "gpu_memory": bytes or None}
+        {"command": "shutdown"}
+    
+    Args:
+        model_id: HuggingFace model ID
+        address: Unix socket path to listen on
+        models_dir: Model cache directory
+        quantization: Weight precision/quantization mode (see QUANTIZATION_MODES)
+        backend: Inference backend (see BACKENDS)
+        authkey: Shared key clients must present
+    """
+    model_and_tokenizer = load_model(model_id, models_dir, quantization=quantization, backend=backend)
+    agents: Dict[str, BaseAgent] = {}
+    agents_lock = threading.Lock()
+    stopping = threading.Event()
+    
+    def get_agent(task: str) -> BaseAgent:
+        with agents_lock:
+            if task not in agents:
+                agents[task] = AGENT_CLASSES[task](model_id, models_dir, quantization=quantization,
+                                                   backend=backend, model_and_tokenizer=model_and_tokenizer)
+            return agents[task]
+    
+    def handle(conn):
+        """Answer one client's requests; generation itself is serialized by the agents"""
+        with conn:
+            while True:
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError):
+                    return
+                
+                if request.get("command") == "shutdown":
+                    conn.send(None)
+                    stopping.set()
+                    # Wake the accept() loop so it sees the flag
+                    Client(address, family="AF_UNIX", authkey=authkey).close()
+                    return
+                if request.get("command") == "info":
+                    conn.send({
+                        "model_id": model_id,
+                        "quantization": quantization,
+                        "backend": backend,
+                        "gpu_memory": _gpu_memory(backend)
+                    })
+                    continue
+                
+                try:
+                    if "task" in request:
+                        response = get_agent(request["task"]).process_batch(
+                            request["inputs"],
+                            custom_instruction_key=request.get("instruction"),
+                            context=request.get("context", "")
+                        )
+                    else:
+                        # Raw prompts reuse any agent; they all share the model
+                        response = get_agent("nlq_refinement").generate_batch(
+                            request["prompts"],
+                            max_length=request.get("max_tokens", 256),
+                            temperature=request.get("temperature", 0.7)
+                        )
+                except Exception as e:
+                    # Report the failure to the client and keep serving
+                    response = e
+                conn.send(response)
+    
+    if os.path.exists(address):
+        os.unlink(address)
+    
+    print(f"Agent server for {model_id} listening on {address}")
+    with Listener(address, family="AF_UNIX", authkey=authkey) as listener:
+        # One thread per connection, so info/shutdown requests are answered while
+        # another client's generation is running
+        while True:
+            conn = listener.accept()
+            if stopping.is_set():
+                conn.close()
+                return
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+
+def _gpu_memory(backend: str) -> Optional[int]:
+    """
+    GPU memory (bytes) this server process holds through PyTorch; None for
+    backends whose model lives in a separate server process
+    """
+    if backend in ("vllm-server", "sglang"):
+        return None
+    if not torch.cuda.is_available():
+        return 0
+    return sum(torch.cuda.memory_reserved(idx) for idx in range(torch.cuda.device_count()))
+
+
+def socket_path(socket_dir: str, model_id: str, quantization: str = "auto",
+                backend: str = "eager", devices: Optional[str] = None) -> str:
+    """
+    Socket a model's agent server listens on inside socket_dir. A server is
+    specific to its quantization and backend, and to the GPUs it runs on
+    (devices, defaulting to this process's CUDA_VISIBLE_DEVICES).
+    """
+    if devices is None:
+        devices = os.environ.get("CUDA_VISIBLE_DEVICES", "all")
+    name = f"{model_id.replace('/', '--')}-{quantization}-{backend}@{devices.replace(',', '_')}.sock"
+    return str(Path(socket_dir) / name)
+
+
+def evict_servers(socket_dir: str, keep: str, memory_budget: Optional[float] = None) -> List[str]:
+    """
+    Shut down the agent servers in socket_dir that run on the same GPUs as the
+    server at keep (other than it), so the next model has the GPUs to itself.
+    
+    Args:
+        socket_dir: Directory of agent server sockets
+        keep: Socket (see socket_path) of the server about to be used
+        memory_budget: Optional bytes of GPU memory other servers may keep
+            resident; the most recently started ones stay while they fit, and
+            servers that cannot report their memory are always shut down
+    
+    Returns:
+        Sockets of the servers that were shut down
+    """
+    devices = Path(keep).name.rsplit("@", 1)[-1]
+    others = sorted(
+        (path for path in Path(socket_dir).glob(f"*@{devices}") if str(path) != keep),
+        key=lambda path: path.stat().st_mtime,
+        reverse=True
+    )
+    
+    evicted = []
+    resident = 0
+    for path in others:
+        try:
+            client = AgentClient(str(path))
+        except (FileNotFoundError, ConnectionRefusedError):
+            # Left behind by a server that is no longer running
+            path.unlink(missing_ok=True)
+            continue
+        
+        gpu_memory = client.info()["gpu_memory"]
+        if memory_budget is not None and gpu_memory is not None and resident + gpu_memory <= memory_budget:
+            resident += gpu_memory
+            client.close()
+            continue
+        
+        print(f"Shutting down agent server {path.name}")
+        client.shutdown()
+        client.close()
+        evicted.append(str(path))
+    return evicted
+
+
+def ensure_server(model_id: str, address: str, models_dir: str = "./models",
+                  quantization: str = "auto", backend: str = "eager",
+                  startup_timeout: float = 600.0) -> str:
+    """
+    Connect to the agent server at address, starting one in the background if
+    none is running. The server outlives this process, so later runs reuse it.
+    
+    Returns:
+        The server address
+    """
+    try:
+        AgentClient(address).close()
+        return address
+    except (FileNotFoundError, ConnectionRefusedError):
+        pass
+    
+    Path(address).parent.mkdir(parents=True, exist_ok=True)
+    process = subprocess.Popen(
+        [sys.executable, "-m", "utils.agent_server",
+         "--model", model_id,
+         "--address", address,
+         # The server runs from the repo root, so relative paths would move
+         "--models-dir", str(Path(models_dir).resolve()),
+         "--quant", quantization,
+         "--backend", backend],
+        cwd=Path(__file__).resolve().parent.parent,
+        start_new_session=True
+    )
+    
+    deadline = time.time() + startup_timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Agent server for {model_id} exited with code {process.returncode}")
+        try:
+            AgentClient(address).close()
+            return address
+        except (FileNotFoundError, ConnectionRefusedError):
+            time.sleep(2)
+    
+    process.terminate()
+    raise RuntimeError(f"Agent server for {model_id} did not start within {startup_timeout:.0f}s")
+
+
+class AgentClient:
+    """Connection to a running agent server"""
+    
+    def __init__(self, address: str, authkey: bytes = DEFAULT_AUTHKEY):
+        self._conn = Client(address, family="AF_UNIX", authkey=authkey)
+    
+    def request(self, message: Dict):
+        """Send one request and return its response, re-raising server-side errors"""
+        self._conn.send(message)
+        response = self._conn.recv()
+        if isinstance(response, Exception):
+            raise response
+        return response
+    
+    def generate_batch(self, prompts: List[str], max_tokens: int = 256,
+                       temperature: float = 0.7) -> List[str]:
+        """Generate responses for raw prompts"""
+        return self.request({"prompts": prompts, "max_tokens": max_tokens, "temperature": temperature})
+    
+    def info(self) -> Dict:
+        """Model, configuration and GPU memory of the server (see serve)"""
+        return self.request({"command": "info"})
+    
+    def shutdown(self):
+        """Stop the server"""
+        self.request({"command": "shutdown"})
+    
+    def close(self):
+        """Close the connection; the server keeps running"""
+        self._conn.close()
+
+
+class RemoteAgent:
+    """
+    Stand-in for an agent whose model lives in an agent server; provides the
+    process_batch/process_stream interface the pipelines use.
+    """
+    
+    def __init__(self, client: AgentClient, task: str):
+        self.client = client
+        self.task = task
+        self.prompt_cache = None
+    
+    def process_batch(self, input_texts: List[str], custom_instruction_key: Optional[str] = None,
+                      context: str = "") -> List[Dict]:
+        return self.client.request({
+            "task": self.task,
+            "inputs": input_texts,
+            "instruction": custom_instruction_key,
+            "context": context
+        })
+    
+    def process_stream(self, input_texts: List[str], batch_size: int,
+                       custom_instruction_key: Optional[str] = None,
+                       context: str = "") -> Iterator[Tuple[List[str], List[Dict], float]]:
+        for start in range(0, len(input_texts), batch_size):
+            batch = input_texts[start:start + batch_size]
+            batch_start = time.time()
+            batch_results = self.process_batch(batch, custom_instruction_key, context)
+            yield batch, batch_results, time.time() - batch_start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a model's agents over a local socket")
+    parser.add_argument("--model", required=True, help="HuggingFace model ID")
+    parser.add_argument("--address", required=True, help="Unix socket path to listen on")
+    parser.add_argument("--models-dir", default="./models", help="Model cache directory")
+    parser.add_argument("--quant", choices=QUANTIZATION_MODES, default="auto", help="Weight precision")
+    parser.add_argument("--backend", choices=BACKENDS, default="eager", help="Inference backend")
+    args = parser.parse_args()
+    
+    serve(args.model, args.address, args.models_dir, args.quant, args.backend)
@@ -0,0 +1,109 @@
+"""
+Request batching for agents serving many concurrent callers.
+Single-prompt generate calls from different threads are queued and coalesced
+into one batched generate call, so the GPU decodes them together instead of
+one request at a time. Generation parameters (max new tokens, temperature,
+stop strings) travel with each request, so agents with different settings can
+share one engine; only requests with equal parameters are batched together.
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+
+# (prompt, max new tokens, temperature, stop strings, future)
+Request = Tuple[str, int, float, Tuple[str, ...], Future]
+
+
+class BatchingEngine:
+    """Queue of pending prompts drained into batched generate calls by one worker thread"""
+    
+    def __init__(self, generate_fn: Callable[[List[str], int, float, Tuple[str, ...]], List[str]],
+                 max_batch_size: int = 32, max_wait: float = 0.005):
+        """
+        Initialize engine and start its worker thread.
+        
+        Args:
+            generate_fn: Batched generation, called as
+                generate_fn(prompts, max_length, temperature, stop_strings)
+            max_batch_size: Most prompts handed to one generate_fn call
+            max_wait: Seconds the worker waits for more requests to join a batch
+                once the first one has arrived
+        """
+        self.generate_fn = generate_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        
+        self._requests: "queue.Queue[Optional[Request]]" = queue.Queue()
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, name="batching-engine", daemon=True)
+        self._worker.start()
+    
+    def submit(self, prompt: str, max_length: int = 256, temperature: float = 0.7,
+               stop_strings: Optional[Sequence[str]] = None) -> Future:
+        """Queue a prompt; the returned future resolves to its response"""
+        if self._closed:
+            raise RuntimeError("BatchingEngine is closed")
+        future = Future()
+        self._requests.put((prompt, max_length, temperature, tuple(stop_strings or ()), future))
+        return future
+    
+    def generate(self, prompt: str, max_length: int = 256, temperature: float = 0.7,
+                 stop_strings: Optional[Sequence[str]] = None) -> str:
+        """Queue a prompt and wait for its response"""
+        return self.submit(prompt, max_length, temperature, stop_strings).result()
+    
+    def close(self):
+        """Finish queued requests and stop the worker thread"""
+        if self._closed:
+            return
+        self._closed = True
+        self._requests.put(None)
+        self._worker.join()
+    
+    def _run(self):
+        while True:
+            request = self._requests.get()
+            if request is None:
+                return
+            
+            # Let concurrent callers join the batch for up to max_wait
+            batch = [request]
+            deadline = time.monotonic() + self.max_wait
+            stop = False
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    stop = True
+                    break
+                batch.append(request)
+            
+            self._generate(batch)
+            if stop:
+                return
+    
+    def _generate(self, batch: List[Request]):
+        """Run one generate_fn call per (max_length, temperature, stop strings) group of the batch"""
+        groups: Dict[Tuple[int, float, Tuple[str, ...]], List[Tuple[str, Future]]] = {}
+        for prompt, max_length, temperature, stop_strings, future in batch:
+            groups.setdefault((max_length, temperature, stop_strings), []).append((prompt, future))
+        
+        for (max_length, temperature, stop_strings), requests in groups.items():
+            try:
+                responses = self.generate_fn([prompt for prompt, _ in requests], max_length,
+                                             temperature, stop_strings)
+            except Exception as e:
+                for _, future in requests:
+                    future.set_exception(e)
+                continue
+            for (_, future), response in zip(requests, responses):
+                future.set_result(response)
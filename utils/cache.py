@@ -0,0 +1,313 @@
+"""
+Prompt cache for agent generations.
+Exact matches are keyed by the SHA-256 of the whitespace-normalized prompt;
+optional semantic matches use sentence-transformer embeddings of the user input
+in a FAISS index.
+Entries are persisted to SQLite per model configuration, task and generation
+parameters so they survive across runs.
+
+Also holds the in-memory conversation cache that keeps the KV state of
+multi-turn conversations between turns.
+"""
+
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+
+DEFAULT_EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+
+class PromptCache:
+    """
+    LRU + SQLite cache of prompt -> response for one model configuration and task.
+    Entries are additionally keyed by the generation parameters (max new tokens,
+    temperature); sampled generations (temperature > 0) are never cached, since
+    replaying one would pass off a single random draw as a deterministic result.
+    """
+    
+    def __init__(self, model_id: str, task: str,
+                 quantization: str = "auto", backend: str = "eager",
+                 stop_strings: Optional[Sequence[str]] = None,
+                 db_path: str = "./results/prompt_cache.sqlite",
+                 max_entries: int = 4096,
+                 semantic_threshold: Optional[float] = None,
+                 embedding_model: str = DEFAULT_EMBEDDING_MODEL):
+        """
+        Initialize cache.
+        
+        Args:
+            model_id: Model the cached responses came from
+            task: Agent task the cached responses belong to
+            quantization: Weight precision/quantization mode the responses came from
+            backend: Inference backend the responses came from
+            stop_strings: Stop strings the responses were generated with
+            db_path: SQLite file used to persist entries across runs
+            max_entries: Maximum number of entries kept in memory
+            semantic_threshold: Optional cosine similarity (e.g. 0.97) above which
+                a near-duplicate input reuses a cached response; requires
+                sentence-transformers and faiss. Only the user input is embedded,
+                and only entries built from the same template and context compete
+            embedding_model: Sentence-transformer model used for semantic matches
+        """
+        self.model_id = model_id
+        self.task = task
+        self.quantization = quantization
+        self.backend = backend
+        self.stop = "\x1f".join(stop_strings or ())
+        self.max_entries = max_entries
+        self.semantic_threshold = semantic_threshold
+        self.hits = 0
+        self.misses = 0
+        
+        # (prompt hash, max new tokens, temperature) -> response, least recently used first
+        self._entries: "OrderedDict[Tuple[str, int, float], str]" = OrderedDict()
+        self._lock = threading.Lock()
+        
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS prompt_responses (
+                model_id TEXT NOT NULL,
+                task TEXT NOT NULL,
+                quantization TEXT NOT NULL,
+                backend TEXT NOT NULL,
+                stop TEXT NOT NULL,
+                max_new_tokens INTEGER NOT NULL,
+                temperature REAL NOT NULL,
+                prompt_hash TEXT NOT NULL,
+                template_hash TEXT,
+                input_text TEXT,
+                prompt TEXT NOT NULL,
+                response TEXT NOT NULL,
+                PRIMARY KEY (model_id, task, quantization, backend, stop,
+                             max_new_tokens, temperature, prompt_hash)
+            )"""
+        )
+        self._db.commit()
+        
+        self._encoder = None
+        # (template hash, max new tokens, temperature) -> (FAISS index, responses)
+        self._indexes: Dict[Tuple[str, int, float], Tuple[Any, List[str]]] = {}
+        if semantic_threshold is not None:
+            self._init_semantic_index(embedding_model)
+    
+    @staticmethod
+    def _normalize(prompt: str) -> str:
+        return " ".join(prompt.split())
+    
+    @classmethod
+    def _hash(cls, prompt: str) -> str:
+        return hashlib.sha256(cls._normalize(prompt).encode("utf-8")).hexdigest()
+    
+    @classmethod
+    def _template_hash(cls, prompt: str, input_text: Optional[str]) -> Optional[str]:
+        """Hash of the prompt with the user input taken out: its instruction and context"""
+        if input_text is None or input_text not in prompt:
+            return None
+        return cls._hash(prompt.replace(input_text, "", 1))
+    
+    @property
+    def _config(self) -> Tuple[str, str, str, str, str]:
+        return (self.model_id, self.task, self.quantization, self.backend, self.stop)
+    
+    def _init_semantic_index(self, embedding_model: str):
+        """Build the FAISS indexes from the persisted inputs of this configuration/task"""
+        from sentence_transformers import SentenceTransformer
+        
+        self._encoder = SentenceTransformer(embedding_model)
+        
+        rows = self._db.execute(
+            """SELECT template_hash, max_new_tokens, temperature, input_text, response
+               FROM prompt_responses
+               WHERE model_id = ? AND task = ? AND quantization = ? AND backend = ? AND stop = ?
+                 AND template_hash IS NOT NULL""",
+            self._config
+        ).fetchall()
+        for template_hash, max_new_tokens, temperature, input_text, response in rows:
+            self._index_add((template_hash, max_new_tokens, temperature), input_text, response)
+    
+    def _index_add(self, group: Tuple[str, int, float], input_text: str, response: str):
+        import faiss
+        
+        if group not in self._indexes:
+            index = faiss.IndexFlatIP(self._encoder.get_sentence_embedding_dimension())
+            self._indexes[group] = (index, [])
+        index, responses = self._indexes[group]
+        index.add(self._embed([input_text]))
+        responses.append(response)
+    
+    def _embed(self, texts: List[str]):
+        return self._encoder.encode(
+            [self._normalize(text) for text in texts],
+            normalize_embeddings=True,
+            convert_to_numpy=True
+        ).astype("float32")
+    
+    def get(self, prompt: str, max_new_tokens: int, temperature: float,
+            input_text: Optional[str] = None) -> Optional[str]:
+        """
+        Get the cached response for a prompt, or None on a miss (always for
+        sampled generations). input_text is the user input inside the prompt;
+        it enables semantic matches against inputs given with the same template.
+        """
+        if temperature > 0:
+            return None
+        
+        prompt_hash = self._hash(prompt)
+        key = (prompt_hash, max_new_tokens, temperature)
+        
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            
+            row = self._db.execute(
+                """SELECT response FROM prompt_responses
+                   WHERE model_id = ? AND task = ? AND quantization = ? AND backend = ? AND stop = ?
+                     AND max_new_tokens = ? AND temperature = ? AND prompt_hash = ?""",
+                (*self._config, max_new_tokens, temperature, prompt_hash)
+            ).fetchone()
+            if row is not None:
+                self._remember(key, row[0])
+                self.hits += 1
+                return row[0]
+            
+            template_hash = self._template_hash(prompt, input_text)
+            group = (template_hash, max_new_tokens, temperature)
+            if template_hash is not None and group in self._indexes:
+                index, responses = self._indexes[group]
+                scores, ids = index.search(self._embed([input_text]), 1)
+                if scores[0][0] >= self.semantic_threshold:
+                    self.hits += 1
+                    return responses[ids[0][0]]
+            
+            self.misses += 1
+            return None
+    
+    def put(self, prompt: str, response: str, max_new_tokens: int, temperature: float,
+            input_text: Optional[str] = None):
+        """Store a response for a prompt; sampled generations are not stored"""
+        if temperature > 0:
+            return
+        
+        prompt_hash = self._hash(prompt)
+        template_hash = self._template_hash(prompt, input_text)
+        
+        with self._lock:
+            self._remember((prompt_hash, max_new_tokens, temperature), response)
+            self._db.execute(
+                "INSERT OR REPLACE INTO prompt_responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (*self._config, max_new_tokens, temperature, prompt_hash,
+                 template_hash, input_text if template_hash else None, prompt, response)
+            )
+            self._db.commit()
+            
+            if self._encoder is not None and template_hash is not None:
+                self._index_add((template_hash, max_new_tokens, temperature), input_text, response)
+    
+    def _remember(self, key: Tuple[str, int, float], response: str):
+        self._entries[key] = response
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    def get_or_compute(self, prompt: str, fn: Callable[[], str], max_new_tokens: int,
+                       temperature: float, input_text: Optional[str] = None) -> str:
+        """Return the cached response for a prompt, computing and storing it on a miss"""
+        if temperature > 0:
+            return fn()
+        
+        response = self.get(prompt, max_new_tokens, temperature, input_text)
+        if response is None:
+            response = fn()
+            self.put(prompt, response, max_new_tokens, temperature, input_text)
+        return response
+    
+    def get_or_compute_batch(self, prompts: List[str], fn: Callable[[List[str]], List[str]],
+                             max_new_tokens: int, temperature: float,
+                             input_texts: Optional[List[str]] = None) -> List[str]:
+        """Batched get_or_compute: fn is called once with only the missing prompts"""
+        if temperature > 0:
+            return fn(prompts)
+        
+        if input_texts is None:
+            input_texts = [None] * len(prompts)
+        responses = [
+            self.get(prompt, max_new_tokens, temperature, input_text)
+            for prompt, input_text in zip(prompts, input_texts)
+        ]
+        missing = [idx for idx, response in enumerate(responses) if response is None]
+        
+        if missing:
+            computed = fn([prompts[idx] for idx in missing])
+            for idx, response in zip(missing, computed):
+                responses[idx] = response
+                self.put(prompts[idx], response, max_new_tokens, temperature, input_texts[idx])
+        
+        return responses
+    
+    def close(self):
+        """Close the SQLite connection"""
+        self._db.close()
+
+
+class ConversationCache:
+    """LRU store of per-conversation generation state, expired after a period of inactivity"""
+    
+    def __init__(self, max_conversations: int = 32, ttl: float = 450.0):
+        """
+        Initialize cache.
+        
+        Args:
+            max_conversations: Maximum number of conversations kept; the least
+                recently used one is dropped first
+            ttl: Seconds after its last turn that a conversation is dropped
+        """
+        self.max_conversations = max_conversations
+        self.ttl = ttl
+        
+        # conversation id -> (time of last use, state), least recently used first
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, conversation_id: str) -> Optional[Any]:
+        """Get the state stored for a conversation, or None if it is unknown or expired"""
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            if conversation_id not in self._entries:
+                return None
+            state = self._entries[conversation_id][1]
+            self._entries[conversation_id] = (now, state)
+            self._entries.move_to_end(conversation_id)
+            return state
+    
+    def put(self, conversation_id: str, state: Any):
+        """Store the state after a conversation's latest turn"""
+        with self._lock:
+            now = time.monotonic()
+            self._entries[conversation_id] = (now, state)
+            self._entries.move_to_end(conversation_id)
+            self._expire(now)
+            while len(self._entries) > self.max_conversations:
+                self._entries.popitem(last=False)
+    
+    def pop(self, conversation_id: str) -> Optional[Any]:
+        """Forget a conversation, returning its state if it was stored"""
+        with self._lock:
+            entry = self._entries.pop(conversation_id, None)
+            return entry[1] if entry is not None else None
+    
+    def _expire(self, now: float):
+        # Entries are ordered by last use, so expired ones are at the front
+        while self._entries:
+            last_used, _ = next(iter(self._entries.values()))
+            if now - last_used < self.ttl:
+                break
+            self._entries.popitem(last=False)
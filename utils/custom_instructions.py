@@ -3,7 +3,8 @@ Custom instruction prompts for agent pipelines.
 Allows flexible instruction setup for each agent in a chain.
 """
 
-from typing import Dict, Optional
+import string
+from typing import Dict, List, Optional, Tuple
 
 
 class CustomInstruction:
@@ -15,6 +16,19 @@ class CustomInstruction:
         self.system_prompt = system_prompt
         self.user_prompt_template = user_prompt_template  # Can use {input} and {context}
         self.description = description
+        
+        # Template parsed once into (literal, field) chunks so rendering is a join
+        self._chunks = self._parse_template(user_prompt_template)
+    
+    @staticmethod
+    def _parse_template(template: str) -> Optional[List[Tuple[str, Optional[str]]]]:
+        """Split a template into (literal, field) chunks; None if it needs full str.format"""
+        chunks = []
+        for literal, field, format_spec, conversion in string.Formatter().parse(template):
+            if format_spec or conversion or field not in (None, "input", "context"):
+                return None
+            chunks.append((literal, field))
+        return chunks
     
     def render_prompt(self, user_input: str, context: str = "") -> tuple:
         """
@@ -24,11 +38,25 @@ class CustomInstruction:
             context: Optional context (schema, previous results, etc.)
         Returns: (system_prompt, user_prompt)
         """
-        user_prompt = self.user_prompt_template.format(
-            input=user_input,
-            context=context if context else ""
+        if self._chunks is None:
+            user_prompt = self.user_prompt_template.format(
+                input=user_input,
+                context=context if context else ""
+            )
+            return self.system_prompt, user_prompt
+        
+        values = {"input": user_input, "context": context if context else ""}
+        user_prompt = "".join(
+            literal + values[field] if field else literal
+            for literal, field in self._chunks
         )
         return self.system_prompt, user_prompt
+    
+    def template_prefix(self) -> str:
+        """Literal text of the user prompt template before its first placeholder"""
+        for literal, _, _, _ in string.Formatter().parse(self.user_prompt_template):
+            return literal
+        return ""
 
 
 class InstructionRegistry:
@@ -3,7 +3,14 @@ NLQ→SQL Pipeline: Chains NLQAgent and SQLAgent together
 Separate benchmark for independent AmbiguityAgent
 """
 
-from typing import Dict, Optional, List
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from difflib import SequenceMatcher
+from typing import Dict, Optional, List, Iterator, Tuple
+
+import torch
+
 from .three_agents import NLQAgent, SQLAgent, AmbiguityAgent
 
 
@@ -17,7 +24,8 @@ class NLQSQLPipeline:
     3. Pass refined query through SQLAgent for SQL generation
     """
     
-    def __init__(self, nlq_agent: NLQAgent, sql_agent: SQLAgent, schema_context: Optional[str] = None):
+    def __init__(self, nlq_agent: NLQAgent, sql_agent: SQLAgent, schema_context: Optional[str] = None,
+                 speculative_sql: bool = False, speculation_threshold: float = 0.9):
         """
         Initialize pipeline with two agents.
         
@@ -25,14 +33,58 @@ class NLQSQLPipeline:
             nlq_agent: NLQAgent instance for query refinement
             sql_agent: SQLAgent instance for SQL generation
             schema_context: Optional database schema context for agents
+            speculative_sql: In execute(), generate SQL for the original query while
+                the NLQ stage runs, and keep it if the refinement barely changed the query.
+                Only takes effect when the stages run on different models: on a shared
+                model the two generations would serialize and speculation only adds latency.
+                A rejected speculation is cancelled at its next decoding step where the SQL
+                agent supports it (HF eager path); otherwise it runs to completion and
+                every rejection costs a full SQL generation
+            speculation_threshold: Word-level similarity between original and refined
+                query (0-1) at which the speculative SQL is kept
         """
         self.nlq_agent = nlq_agent
         self.sql_agent = sql_agent
         self.schema_context = schema_context
+        if speculative_sql and self._share_model(nlq_agent, sql_agent):
+            print("Speculative SQL disabled: the NLQ and SQL stages share one model")
+            speculative_sql = False
+        if speculative_sql and not getattr(sql_agent, "supports_cancellation", lambda: False)():
+            print("Speculative SQL cannot be cancelled on this SQL agent; "
+                  "each rejected speculation runs to completion")
+        self.speculative_sql = speculative_sql
+        self.speculation_threshold = speculation_threshold
+        self._speculation_pool = ThreadPoolExecutor(max_workers=1) if speculative_sql else None
+    
+    def close(self):
+        """Stop the speculation worker thread and the agents' batching workers"""
+        if self._speculation_pool is not None:
+            self._speculation_pool.shutdown(wait=True)
+            self._speculation_pool = None
+        for agent in (self.nlq_agent, self.sql_agent):
+            # Remote agents have no local workers
+            if hasattr(agent, "close"):
+                agent.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    @staticmethod
+    def _share_model(nlq_agent, sql_agent) -> bool:
+        """Whether both agents generate through the same model (or agent server connection)"""
+        for attr in ("model", "client"):
+            resource = getattr(nlq_agent, attr, None)
+            if resource is not None and resource is getattr(sql_agent, attr, None):
+                return True
+        return False
     
     def execute(self, user_query: str, 
                 nlq_instruction_key: Optional[str] = None,
-                sql_instruction_key: Optional[str] = None) -> Dict:
+                sql_instruction_key: Optional[str] = None,
+                conversation_id: Optional[str] = None) -> Dict:
         """
         Execute pipeline on user query.
         
@@ -40,6 +92,8 @@ class NLQSQLPipeline:
             user_query: Original user query
             nlq_instruction_key: Optional custom instruction for NLQ stage
             sql_instruction_key: Optional custom instruction for SQL stage
+            conversation_id: Optional multi-turn conversation the query belongs to;
+                each stage keeps the KV cache of the conversation's earlier turns
         
         Returns:
             Dictionary with:
@@ -48,24 +102,159 @@ class NLQSQLPipeline:
             - sql: Generated SQL from SQLAgent
             - stages: Details from each stage
         """
+        # The SQL stage's offloaded KV (if any) is copied back while NLQ generates
+        if conversation_id is not None and hasattr(self.sql_agent, "prefetch_conversation"):
+            self.sql_agent.prefetch_conversation(conversation_id)
+        
+        speculative = None
+        if self._speculation_pool is not None and conversation_id is None:
+            cancel = threading.Event()
+            speculative = self._speculation_pool.submit(
+                self._speculate_sql, user_query, sql_instruction_key, cancel
+            )
+        
         # Stage 1: NLQ Refinement - pass schema context
         nlq_result = self.nlq_agent.process(
             user_query,
             custom_instruction_key=nlq_instruction_key,
-            context=self.schema_context or ""
+            context=self.schema_context or "",
+            conversation_id=conversation_id
         )
         refined_query = nlq_result["refined_query"]
         
+        # Keep the speculative SQL only if refinement left the query nearly unchanged;
+        # otherwise stop it so it does not compete with stage 2 (or delay the next
+        # query's speculation) for the SQL model
+        if speculative is not None:
+            if self._query_similarity(user_query, refined_query) >= self.speculation_threshold:
+                sql_result = speculative.result()
+                sql_result["speculative"] = True
+                return self._build_result(user_query, nlq_result, sql_result)
+            cancel.set()
+            speculative.add_done_callback(self._report_speculation_error)
+        
         # Stage 2: SQL Generation - pass refined query and schema context
         sql_result = self.sql_agent.process(
             refined_query,
             custom_instruction_key=sql_instruction_key,
+            context=self.schema_context or "",
+            conversation_id=conversation_id
+        )
+        
+        return self._build_result(user_query, nlq_result, sql_result)
+    
+    def execute_batch(self, user_queries: List[str],
+                      nlq_instruction_key: Optional[str] = None,
+                      sql_instruction_key: Optional[str] = None) -> List[Dict]:
+        """
+        Execute pipeline on several user queries at once.
+        
+        Each stage runs as one batched generate call, so a batch costs two
+        model invocations instead of two per query.
+        
+        Args:
+            user_queries: Original user queries
+            nlq_instruction_key: Optional custom instruction for NLQ stage
+            sql_instruction_key: Optional custom instruction for SQL stage
+        
+        Returns:
+            List of result dictionaries (same shape as execute), in input order
+        """
+        nlq_results = self.nlq_agent.process_batch(
+            user_queries,
+            custom_instruction_key=nlq_instruction_key,
+            context=self.schema_context or ""
+        )
+        
+        sql_results = self.sql_agent.process_batch(
+            [nlq_result["refined_query"] for nlq_result in nlq_results],
+            custom_instruction_key=sql_instruction_key,
+            context=self.schema_context or ""
+        )
+        
+        return [
+            self._build_result(user_query, nlq_result, sql_result)
+            for user_query, nlq_result, sql_result in zip(user_queries, nlq_results, sql_results)
+        ]
+    
+    def execute_stream(self, user_queries: List[str], batch_size: int,
+                       nlq_instruction_key: Optional[str] = None,
+                       sql_instruction_key: Optional[str] = None) -> Iterator[Tuple[List[str], List[Dict], float]]:
+        """
+        Execute pipeline batch by batch; NLQ prompts for upcoming batches are
+        tokenized in the background while the current batch generates.
+        
+        Args:
+            user_queries: Original user queries
+            batch_size: Number of queries per generate call
+            nlq_instruction_key: Optional custom instruction for NLQ stage
+            sql_instruction_key: Optional custom instruction for SQL stage
+        
+        Yields:
+            (batch queries, batch results, batch wall time in seconds)
+        """
+        nlq_stream = self.nlq_agent.process_stream(
+            user_queries,
+            batch_size,
+            custom_instruction_key=nlq_instruction_key,
             context=self.schema_context or ""
         )
         
+        for batch, nlq_results, nlq_time in nlq_stream:
+            sql_start = time.time()
+            sql_results = self.sql_agent.process_batch(
+                [nlq_result["refined_query"] for nlq_result in nlq_results],
+                custom_instruction_key=sql_instruction_key,
+                context=self.schema_context or ""
+            )
+            batch_time = nlq_time + time.time() - sql_start
+            
+            yield batch, [
+                self._build_result(user_query, nlq_result, sql_result)
+                for user_query, nlq_result, sql_result in zip(batch, nlq_results, sql_results)
+            ], batch_time
+    
+    def _speculate_sql(self, user_query: str, sql_instruction_key: Optional[str],
+                       cancel: threading.Event) -> Dict:
+        """
+        SQL for the unrefined query. HF models on a GPU get their own CUDA stream on
+        the SQL model's device so it can overlap the NLQ stage.
+        """
+        process_kwargs = {}
+        if getattr(self.sql_agent, "supports_cancellation", lambda: False)():
+            process_kwargs["cancel_event"] = cancel
+        
+        device = getattr(getattr(self.sql_agent, "model", None), "device", None)
+        if not isinstance(device, torch.device) or device.type != "cuda":
+            return self.sql_agent.process(user_query, sql_instruction_key, self.schema_context or "",
+                                          **process_kwargs)
+        
+        with torch.cuda.device(device):
+            stream = torch.cuda.Stream(device=device)
+            with torch.cuda.stream(stream):
+                result = self.sql_agent.process(user_query, sql_instruction_key, self.schema_context or "",
+                                                **process_kwargs)
+            stream.synchronize()
+        return result
+    
+    @staticmethod
+    def _report_speculation_error(future: Future):
+        """Surface errors of discarded speculations, which nobody waits on"""
+        error = future.exception()
+        if error is not None:
+            print(f"Discarded speculative SQL generation failed: {error}")
+    
+    @staticmethod
+    def _query_similarity(original: str, refined: str) -> float:
+        """Word-level similarity (0-1) of two queries"""
+        return SequenceMatcher(None, original.lower().split(), refined.lower().split()).ratio()
+    
+    @staticmethod
+    def _build_result(user_query: str, nlq_result: Dict, sql_result: Dict) -> Dict:
+        """Combine stage outputs into the pipeline result"""
         return {
             "original_query": user_query,
-            "refined_query": refined_query,
+            "refined_query": nlq_result["refined_query"],
             "sql": sql_result["sql"],
             "stages": {
                 "nlq": nlq_result,
@@ -87,18 +276,38 @@ class AmbiguityPipeline:
         self.ambiguity_agent = ambiguity_agent
     
     def execute(self, user_query: str, 
-                instruction_key: Optional[str] = None) -> Dict:
+                instruction_key: Optional[str] = None,
+                conversation_id: Optional[str] = None) -> Dict:
         """
         Execute ambiguity detection on query.
         
         Args:
             user_query: Query to analyze
             instruction_key: Optional custom instruction
+            conversation_id: Optional multi-turn conversation the query belongs to
         
         Returns:
             Dictionary with ambiguity classification
         """
         return self.ambiguity_agent.process(
             user_query,
+            custom_instruction_key=instruction_key,
+            conversation_id=conversation_id
+        )
+    
+    def execute_batch(self, user_queries: List[str],
+                      instruction_key: Optional[str] = None) -> List[Dict]:
+        """
+        Execute ambiguity detection on several queries with one batched generate call.
+        
+        Args:
+            user_queries: Queries to analyze
+            instruction_key: Optional custom instruction
+        
+        Returns:
+            List of classification dictionaries, in input order
+        """
+        return self.ambiguity_agent.process_batch(
+            user_queries,
             custom_instruction_key=instruction_key
         )
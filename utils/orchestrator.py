@@ -0,0 +1,109 @@
+"""
+Three-agent orchestrator: runs ambiguity detection and the NLQ→SQL pipeline
+side by side, each on its own GPU when more than one is available
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+from .three_agents import AmbiguityAgent, NLQAgent, SQLAgent, load_model
+from .nlq_sql_pipeline import NLQSQLPipeline
+
+
+def default_devices() -> Tuple[str, str]:
+    """
+    (ambiguity device, NLQ/SQL device): the independent ambiguity agent gets
+    cuda:0 and the pipelined NLQ and SQL agents share cuda:1; with fewer
+    GPUs everything runs on one device.
+    """
+    if torch.cuda.device_count() >= 2:
+        return "cuda:0", "cuda:1"
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    return device, device
+
+
+class ThreeAgentOrchestrator:
+    """Runs AmbiguityAgent and NLQSQLPipeline concurrently on per-device model replicas"""
+    
+    def __init__(self, model_id: str, models_dir: str = "./models",
+                 quantization: str = "auto", backend: str = "eager",
+                 schema_context: Optional[str] = None,
+                 devices: Optional[Tuple[str, str]] = None):
+        """
+        Initialize agents, loading one model replica per device.
+        
+        Args:
+            model_id: HuggingFace model ID
+            models_dir: Model cache directory
+            quantization: Weight precision/quantization mode (see QUANTIZATION_MODES)
+            backend: Inference backend (see BACKENDS)
+            schema_context: Optional database schema context for the pipeline
+            devices: Optional (ambiguity device, NLQ/SQL device), see default_devices()
+        """
+        ambiguity_device, pipeline_device = devices or default_devices()
+        
+        # generate() spends its time in CUDA kernels, so two threads keep both GPUs busy
+        self._pool = ThreadPoolExecutor(max_workers=2)
+        
+        # Load the replicas concurrently (from_pretrained spends its time in file I/O
+        # and device copies); one load per distinct device, since two loads of the
+        # same replica would race on the model cache
+        loads = [
+            self._pool.submit(load_model, model_id, models_dir, device, quantization, backend)
+            for device in dict.fromkeys((ambiguity_device, pipeline_device))
+        ]
+        for load in loads:
+            load.result()
+        
+        # Agents on the same device share one replica through the model cache
+        self.ambiguity_agent = AmbiguityAgent.from_shared(
+            model_id, models_dir, ambiguity_device, quantization, backend
+        )
+        self.pipeline = NLQSQLPipeline(
+            NLQAgent.from_shared(model_id, models_dir, pipeline_device, quantization, backend),
+            SQLAgent.from_shared(model_id, models_dir, pipeline_device, quantization, backend),
+            schema_context=schema_context
+        )
+    
+    def execute(self, user_query: str,
+                ambiguity_instruction_key: Optional[str] = None,
+                nlq_instruction_key: Optional[str] = None,
+                sql_instruction_key: Optional[str] = None) -> Dict:
+        """
+        Run ambiguity detection and the NLQ→SQL pipeline on one query concurrently.
+        
+        Returns:
+            Pipeline result dictionary with an added "ambiguity" entry
+        """
+        ambiguity = self._pool.submit(
+            self.ambiguity_agent.process, user_query, ambiguity_instruction_key
+        )
+        result = self.pipeline.execute(user_query, nlq_instruction_key, sql_instruction_key)
+        result["ambiguity"] = ambiguity.result()
+        return result
+    
+    def execute_batch(self, user_queries: List[str],
+                      ambiguity_instruction_key: Optional[str] = None,
+                      nlq_instruction_key: Optional[str] = None,
+                      sql_instruction_key: Optional[str] = None) -> List[Dict]:
+        """
+        Batched execute: one batched ambiguity call runs alongside the two
+        batched pipeline stages.
+        
+        Returns:
+            List of result dictionaries (same shape as execute), in input order
+        """
+        ambiguity = self._pool.submit(
+            self.ambiguity_agent.process_batch, user_queries, ambiguity_instruction_key
+        )
+        results = self.pipeline.execute_batch(user_queries, nlq_instruction_key, sql_instruction_key)
+        for result, ambiguity_result in zip(results, ambiguity.result()):
+            result["ambiguity"] = ambiguity_result
+        return results
+    
+    def close(self):
+        """Stop the worker threads"""
+        self._pool.shutdown(wait=True)
+        self.pipeline.close()
@@ -0,0 +1,199 @@
+"""
+OpenAI-compatible inference server backends (vLLM, SGLang).
+Each runs its server in a subprocess and sends prompts to it concurrently, so
+the server's continuous batching schedules them instead of the benchmark loop.
+"""
+
+import asyncio
+import atexit
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from typing import Dict, List, Optional, Sequence
+
+try:
+    from huggingface_hub import get_token
+except ImportError:
+    # huggingface_hub < 0.21
+    from huggingface_hub import HfFolder
+    get_token = HfFolder.get_token
+
+
+# Requests in flight per agent; the server batches whatever is in flight
+CONCURRENCY = 8
+
+
+def _free_port() -> int:
+    """A port no other process is listening on, picked by the OS"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def _server_env(models_dir: str) -> Dict[str, str]:
+    """
+    Environment for a server subprocess: every Hugging Face file it resolves
+    (weights, tokenizer, configs) comes from models_dir, not ~/.cache/huggingface
+    """
+    env = dict(os.environ)
+    env["HF_HOME"] = models_dir
+    # Same layout as the cache_dir / --download-dir used everywhere else
+    env["HF_HUB_CACHE"] = models_dir
+    env["HUGGINGFACE_HUB_CACHE"] = models_dir
+    # HF_HOME also moves the stored login; forward it so gated models still download
+    if "HF_TOKEN" not in env:
+        token = get_token()
+        if token:
+            env["HF_TOKEN"] = token
+    return env
+
+
+class OpenAIServer:
+    """An inference server subprocess for one model, plus an OpenAI client for it"""
+    
+    name = "server"
+    
+    def __init__(self, model_id: str, port: Optional[int] = None, models_dir: str = "./models",
+                 dtype: str = "auto", quantization: Optional[str] = None,
+                 startup_timeout: float = 600.0):
+        """
+        Start the server and wait until it is ready.
+        
+        Args:
+            model_id: HuggingFace model ID to serve
+            port: Local port the server listens on; by default a free one, so
+                servers started by concurrent benchmark workers never collide
+            models_dir: Model download directory
+            dtype: Weight dtype passed to the server
+            quantization: Optional server quantization method (e.g. "bitsandbytes", "fp8")
+            startup_timeout: Seconds to wait for the server to become healthy
+        """
+        self.model_id = model_id
+        self.port = port if port is not None else _free_port()
+        self.base_url = f"http://localhost:{self.port}/v1"
+        
+        print(f"Starting {self.name} server for {model_id} on port {self.port}")
+        self._process = subprocess.Popen(self._command(models_dir, dtype, quantization),
+                                         env=_server_env(models_dir))
+        atexit.register(self.stop)
+        self._wait_until_ready(startup_timeout)
+    
+    def _command(self, models_dir: str, dtype: str, quantization: Optional[str]) -> List[str]:
+        """Command line that launches the server"""
+        raise NotImplementedError
+    
+    def _wait_until_ready(self, timeout: float):
+        """Poll the health endpoint until the model is loaded"""
+        deadline = time.time() + timeout
+        health_url = f"http://localhost:{self.port}/health"
+        
+        while time.time() < deadline:
+            if self._process.poll() is not None:
+                raise RuntimeError(f"{self.name} server for {self.model_id} exited with code {self._process.returncode}")
+            try:
+                with urllib.request.urlopen(health_url, timeout=5) as response:
+                    if response.status == 200:
+                        return
+            except (urllib.error.URLError, ConnectionError):
+                pass
+            time.sleep(2)
+        
+        self.stop()
+        raise TimeoutError(f"{self.name} server for {self.model_id} did not start within {timeout:.0f}s")
+    
+    def generate(self, prompts: List[str], max_tokens: int, temperature: float,
+                 top_p: float = 0.95, stop: Optional[Sequence[str]] = None) -> List[str]:
+        """
+        Complete every prompt, keeping up to CONCURRENCY requests in flight.
+        Completions end at the first stop string, which is kept in the output when
+        the server reports which one matched.
+        """
+        return asyncio.run(self._generate_async(prompts, max_tokens, temperature, top_p, stop))
+    
+    async def _generate_async(self, prompts: List[str], max_tokens: int, temperature: float,
+                              top_p: float, stop: Optional[Sequence[str]]) -> List[str]:
+        # openai is only needed for the server backends
+        from openai import AsyncOpenAI
+        
+        client = AsyncOpenAI(base_url=self.base_url, api_key="EMPTY")
+        semaphore = asyncio.Semaphore(CONCURRENCY)
+        
+        async def complete(prompt: str) -> str:
+            async with semaphore:
+                # Prompts already carry their own instruction formatting, so the
+                # plain completions endpoint is used rather than chat templates
+                response = await client.completions.create(
+                    model=self.model_id,
+                    prompt=prompt,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    top_p=top_p,
+                    stop=list(stop) if stop else None
+                )
+                choice = response.choices[0]
+                # Match HF generate and vLLM, which keep the stop string in the output
+                text = choice.text
+                if stop and choice.finish_reason == "stop" and getattr(choice, "stop_reason", None) in stop:
+                    text += choice.stop_reason
+                return text.strip()
+        
+        try:
+            return await asyncio.gather(*[complete(prompt) for prompt in prompts])
+        finally:
+            await client.close()
+    
+    def stop(self):
+        """Terminate the server subprocess"""
+        if self._process.poll() is None:
+            self._process.terminate()
+            try:
+                self._process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+
+
+class VLLMServer(OpenAIServer):
+    """`vllm serve` with continuous batching and automatic prefix caching"""
+    
+    name = "vLLM"
+    
+    def _command(self, models_dir: str, dtype: str, quantization: Optional[str]) -> List[str]:
+        command = [
+            "vllm", "serve", self.model_id,
+            "--port", str(self.port),
+            "--download-dir", models_dir,
+            "--dtype", dtype,
+            "--max-num-batched-tokens", "8192",
+            "--max-num-seqs", "512",
+            "--enable-prefix-caching",
+            "--trust-remote-code"
+        ]
+        if quantization:
+            command += ["--quantization", quantization]
+        if quantization == "bitsandbytes":
+            command += ["--load-format", "bitsandbytes"]
+        return command
+
+
+class SGLangServer(OpenAIServer):
+    """SGLang server; its RadixAttention cache reuses any prompt prefix already seen"""
+    
+    name = "SGLang"
+    
+    def _command(self, models_dir: str, dtype: str, quantization: Optional[str]) -> List[str]:
+        # The radix (prefix) cache is on unless --disable-radix-cache is passed
+        command = [
+            sys.executable, "-m", "sglang.launch_server",
+            "--model-path", self.model_id,
+            "--port", str(self.port),
+            "--download-dir", models_dir,
+            "--dtype", dtype,
+            "--trust-remote-code"
+        ]
+        if quantization:
+            command += ["--quantization", quantization]
+        return command
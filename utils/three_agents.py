@@ -5,109 +5,1470 @@ Three-Agent System:
 3. SQLAgent - SQL generation from refined queries
 """
 
+import copy
+import fnmatch
+import gc
+import hashlib
+import importlib.util
 import os
-from typing import Optional, Dict
+import re
+import threading
+import time
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional, Dict, List, Tuple, Any, Iterator, Sequence, Union
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from huggingface_hub import HfApi, constants as hf_constants, snapshot_download
+from transformers import (AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig, DynamicCache,
+                          StoppingCriteria, StoppingCriteriaList)
+from transformers.utils import is_flash_attn_2_available
 
-from .custom_instructions import get_instruction
+from .custom_instructions import CustomInstruction, get_instruction
+from .cache import ConversationCache, PromptCache
+from .batching_engine import BatchingEngine
+from .server_backend import OpenAIServer, VLLMServer, SGLangServer
+
+
+QUANTIZATION_MODES = ("auto", "bf16", "int8", "int4", "int4-awq", "fp8")
+
+BACKENDS = ("eager", "compiled", "vllm", "vllm-server", "sglang")
+
+# Backends that hand whole prompt lists to a serving engine instead of running HF generate
+SERVING_BACKENDS = ("vllm", "vllm-server", "sglang")
+
+# Prompt plus new tokens are kept within the model's context window, capped here;
+# prompts are only truncated when they would not fit
+MAX_CONTEXT_TOKENS = 4096
+
+# Compiled models see prompt lengths rounded up to this multiple, bounding recompiles
+COMPILE_PAD_MULTIPLE = 64
+
+# Speculative decoding only pays off when the target is much slower than the draft
+SPECULATIVE_MIN_PARAMETERS = 7_000_000_000
+
+# Draft tokens proposed per target forward pass during speculative decoding
+NUM_ASSISTANT_TOKENS = 5
+
+# Files download_model fetches: safetensors weights, configs, tokenizer files
+# (SentencePiece/tiktoken models, BPE merges) and remote code. Original-format
+# checkpoints (e.g. Llama's original/consolidated.*.pth, Mistral's
+# consolidated.safetensors) duplicate the weights and are skipped
+DOWNLOAD_ALLOW_PATTERNS = ("*.safetensors", "*.json", "*.model", "*.tiktoken", "*.txt", "*.py", "tokenizer*")
+DOWNLOAD_IGNORE_PATTERNS = ("original/*", "consolidated*")
+# Weights fetched instead when a repo has no safetensors (the index is a *.json)
+DOWNLOAD_BIN_PATTERNS = ("*.bin",)
+
+# Stand-in for the input when splitting a prompt into its static segments
+_INPUT_MARKER = "\x00input\x00"
+
+# Inputs whose edges tend to merge with neighbouring text in byte-level BPE
+# pretokenizers (trailing punctuation + newline, leading space/punctuation);
+# segment encoding is only used when it reproduces the full-prompt ids for all of them
+_SEGMENT_PROBES = (
+    "How many users signed up last month?",
+    "List all merchants.",
+    " total revenue (2023)",
+    "\"refunds\" by day!",
+    "count: 42",
+)
+
+# Response parsing, compiled once; case-insensitive searches avoid lowercasing a copy
+_AMBIGUOUS_RE = re.compile("ambiguous", re.IGNORECASE)
+_NOT_AMBIGUOUS_RE = re.compile("not ambiguous", re.IGNORECASE)
+_CLEAR_RE = re.compile("clear", re.IGNORECASE)
+# Labels and code fences models put before the SQL itself
+_SQL_LABEL_RE = re.compile(r"(?:```(?:sql)?|SQL:|sql:|QUERY:|Query:)\s*")
+
+
+def half_precision_dtype() -> torch.dtype:
+    """bfloat16 where the GPU supports it (Ampere+), float16 otherwise"""
+    return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+
+
+def get_quantization_kwargs(quantization: str) -> Dict:
+    """
+    Get from_pretrained keyword arguments for a quantization mode.
+    
+    Args:
+        quantization: One of QUANTIZATION_MODES. "auto" loads half precision
+            weights on CUDA (see half_precision_dtype) and keeps the checkpoint
+            dtype on CPU, "bf16" loads bfloat16 weights, "int8"/"int4" load
+            bitsandbytes weight-only quantized weights (CUDA only), "int4-awq"
+            loads an AWQ-quantized checkpoint (CUDA only); "fp8" is only
+            available on the serving backends
+    
+    Returns:
+        Keyword arguments for AutoModelForCausalLM.from_pretrained
+    """
+    if quantization == "auto":
+        # Checkpoints stored in fp32 would otherwise double weight memory and traffic
+        if torch.cuda.is_available():
+            return {"torch_dtype": half_precision_dtype()}
+        return {"torch_dtype": "auto"}
+    if quantization == "bf16":
+        return {"torch_dtype": torch.bfloat16}
+    if quantization == "int8":
+        return {
+            "torch_dtype": half_precision_dtype(),
+            "quantization_config": BitsAndBytesConfig(load_in_8bit=True)
+        }
+    if quantization == "int4":
+        return {
+            "torch_dtype": half_precision_dtype(),
+            "quantization_config": BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=half_precision_dtype()
+            )
+        }
+    if quantization == "int4-awq":
+        # The checkpoint carries its own AWQ quantization config; AWQ kernels run in fp16
+        return {"torch_dtype": torch.float16}
+    if quantization == "fp8":
+        raise ValueError("fp8 quantization is only supported by the serving backends")
+    raise ValueError(f"Unknown quantization '{quantization}', expected one of {QUANTIZATION_MODES}")
+
+
+def _serving_weight_args(quantization: str, backend: str) -> Tuple[str, Optional[str]]:
+    """(dtype, engine quantization method) for a quantization mode on a serving backend"""
+    if quantization == "int8" or (quantization == "int4" and backend == "sglang"):
+        raise ValueError(f"{quantization} quantization is not supported by the {backend} backend")
+    if quantization == "bf16":
+        return "bfloat16", None
+    if quantization == "int4":
+        return "auto", "bitsandbytes"
+    if quantization == "fp8":
+        # Weights are quantized to fp8 on load; no pre-quantized checkpoint needed
+        return "auto", "fp8"
+    # "int4-awq" checkpoints are detected by the engine, which picks its AWQ kernel
+    return "auto", None
+
+
+# Loaded (model, tokenizer) pairs, shared by every agent in the process
+_MODEL_CACHE: Dict[Tuple[str, str, str, str], Tuple[Any, Any]] = {}
+
+# One lock per loaded model so agents sharing it from several threads run one forward at a time
+_GENERATE_LOCKS: "weakref.WeakKeyDictionary[Any, threading.Lock]" = weakref.WeakKeyDictionary()
+_GENERATE_LOCKS_GUARD = threading.Lock()
+
+
+# Model -> BatchingEngines generating with it, closed when the model is dropped
+_BATCHING_ENGINES: "weakref.WeakKeyDictionary[Any, List[BatchingEngine]]" = weakref.WeakKeyDictionary()
+
+
+def _generate_lock(model) -> threading.Lock:
+    """Lock serializing generate/forward calls on a shared model"""
+    with _GENERATE_LOCKS_GUARD:
+        if model not in _GENERATE_LOCKS:
+            _GENERATE_LOCKS[model] = threading.Lock()
+        return _GENERATE_LOCKS[model]
+
+
+class _CancelCriteria(StoppingCriteria):
+    """Ends every sequence of a running generate call once the event is set"""
+    
+    def __init__(self, event: threading.Event):
+        self.event = event
+    
+    def __call__(self, input_ids: torch.Tensor, scores: torch.Tensor, **kwargs) -> torch.Tensor:
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool,
+                          device=input_ids.device)
+
+
+def download_model(model_id: str, models_dir: str = "./models", max_workers: int = 8) -> str:
+    """
+    Download the files needed to load a model (see DOWNLOAD_ALLOW_PATTERNS)
+    into the cache without loading it.
+    
+    Args:
+        model_id: HuggingFace model ID
+        models_dir: Model cache directory
+        max_workers: Number of files fetched concurrently
+    
+    Returns:
+        Local snapshot path
+    """
+    # hf_transfer (optional) downloads large shards in parallel chunks; the env
+    # var is only read when huggingface_hub is imported, so set the constant too
+    if importlib.util.find_spec("hf_transfer") is not None:
+        os.environ["HF_HUB_ENABLE_HF_TRANSFER"] = "1"
+        hf_constants.HF_HUB_ENABLE_HF_TRANSFER = True
+    
+    return snapshot_download(
+        repo_id=model_id,
+        cache_dir=models_dir,
+        max_workers=max_workers,
+        allow_patterns=download_allow_patterns(HfApi().list_repo_files(model_id)),
+        ignore_patterns=list(DOWNLOAD_IGNORE_PATTERNS)
+    )
+
+
+def download_allow_patterns(repo_files: List[str]) -> List[str]:
+    """
+    Allow patterns for a repo's files: DOWNLOAD_ALLOW_PATTERNS, plus the
+    PyTorch .bin weights when the repo has no (non-ignored) safetensors weights
+    """
+    patterns = list(DOWNLOAD_ALLOW_PATTERNS)
+    has_safetensors = any(
+        name.endswith(".safetensors")
+        and not any(fnmatch.fnmatch(name, ignored) for ignored in DOWNLOAD_IGNORE_PATTERNS)
+        for name in repo_files
+    )
+    if not has_safetensors:
+        patterns.extend(DOWNLOAD_BIN_PATTERNS)
+    return patterns
+
+
+def load_model(model_id: str, models_dir: str = "./models", device: Optional[str] = None,
+               quantization: str = "auto", backend: str = "eager",
+               local_files_only: bool = False) -> Tuple[Any, Any]:
+    """
+    Load a model and tokenizer, reusing an already loaded copy when possible.
+    
+    Args:
+        model_id: HuggingFace model ID
+        models_dir: Model cache directory
+        device: Target device (defaults to CUDA when available)
+        quantization: Weight precision/quantization mode (see QUANTIZATION_MODES)
+        backend: "eager", "compiled" to run the forward pass through
+            torch.compile with a static KV cache, or "vllm" to serve the model
+            with vLLM (PagedAttention + continuous batching) in this process,
+            "vllm-server" / "sglang" to serve it from a vLLM / SGLang server
+            subprocess; these serving backends return a vllm.LLM or an
+            OpenAIServer in place of the HF model
+        local_files_only: Load from the cache without touching the network
+            (e.g. after download_model)
+    
+    Returns:
+        (model, tokenizer) tuple
+    """
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend '{backend}', expected one of {BACKENDS}")
+    
+    key = (model_id, quantization, device, backend)
+    if key in _MODEL_CACHE:
+        return _MODEL_CACHE[key]
+    
+    if quantization in ("int8", "int4", "int4-awq", "fp8") and not device.startswith("cuda"):
+        raise ValueError(f"{quantization} quantization requires a CUDA device")
+    
+    if backend == "vllm":
+        _MODEL_CACHE[key] = _load_vllm_model(model_id, models_dir, quantization)
+        return _MODEL_CACHE[key]
+    if backend in ("vllm-server", "sglang"):
+        _MODEL_CACHE[key] = _start_server(model_id, models_dir, quantization, backend, local_files_only)
+        return _MODEL_CACHE[key]
+    
+    tokenizer = AutoTokenizer.from_pretrained(
+        model_id,
+        # Rust-backed tokenizers batch-encode without per-prompt Python overhead
+        use_fast=True,
+        trust_remote_code=True,
+        cache_dir=models_dir,
+        local_files_only=local_files_only
+    )
+    
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    # Decoder-only models must be left-padded for batched generation
+    tokenizer.padding_side = "left"
+    
+    model_kwargs = dict(
+        **get_quantization_kwargs(quantization),
+        # Weights are placed on the device as they load, never as an fp32 host copy
+        device_map="auto" if device == "cuda" else {"": device},
+        # Skip materializing randomly initialized weights before the checkpoint is read
+        low_cpu_mem_usage=True,
+        trust_remote_code=True,
+        cache_dir=models_dir,
+        local_files_only=local_files_only
+    )
+    
+    # FlashAttention-2 kernels need Ampere or newer and the flash-attn package; checking
+    # for the package up front saves a failed load attempt when it is not installed
+    if (device.startswith("cuda") and torch.cuda.get_device_capability(device)[0] >= 8
+            and is_flash_attn_2_available()):
+        try:
+            model = AutoModelForCausalLM.from_pretrained(
+                model_id, attn_implementation="flash_attention_2", **model_kwargs
+            )
+        except (ImportError, ValueError) as e:
+            # Not supported by this architecture/dtype
+            print(f"FlashAttention-2 unavailable for {model_id} ({e}), using sdpa")
+            model = AutoModelForCausalLM.from_pretrained(model_id, attn_implementation="sdpa", **model_kwargs)
+    else:
+        model = AutoModelForCausalLM.from_pretrained(model_id, attn_implementation="sdpa", **model_kwargs)
+    
+    # Recorded in the log so benchmark numbers can be tied to the attention kernel
+    print(f"{model_id}: attn_impl={model.config._attn_implementation}")
+    
+    model.eval()
+    
+    if device.startswith("cuda"):
+        # Any fp32 matmuls left (e.g. upcast norms or lm_head) may use TF32 tensor cores
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.set_float32_matmul_precision("high")
+    
+    if backend == "compiled":
+        # CUDA graphs need Volta or newer; older GPUs and CPUs run the model eagerly
+        if not device.startswith("cuda") or torch.cuda.get_device_capability(device)[0] < 7:
+            print(f"torch.compile backend needs a CUDA GPU with compute capability >= 7.0, "
+                  f"running {model_id} eagerly")
+        else:
+            # A static cache keeps decode-step shapes fixed so CUDA graphs can be replayed
+            model.generation_config.cache_implementation = "static"
+            model.forward = torch.compile(model.forward, mode="reduce-overhead", dynamic=False)
+            _warmup(model, tokenizer)
+    
+    _MODEL_CACHE[key] = (model, tokenizer)
+    return model, tokenizer
+
+
+def _warmup(model, tokenizer):
+    """Run one short generate so compilation and graph capture happen before timing starts"""
+    inputs = tokenizer(
+        "Hello",
+        return_tensors="pt",
+        padding=True,
+        pad_to_multiple_of=COMPILE_PAD_MULTIPLE
+    ).to(model.device)
+    
+    with torch.inference_mode():
+        model.generate(
+            **inputs,
+            max_new_tokens=4,
+            do_sample=False,
+            pad_token_id=tokenizer.pad_token_id
+        )
+
+
+def _load_vllm_model(model_id: str, models_dir: str, quantization: str) -> Tuple[Any, Any]:
+    """Load a model into a vLLM engine; returns (vllm.LLM, tokenizer)"""
+    # vLLM is an optional dependency, only needed for this backend
+    from vllm import LLM
+    
+    dtype, method = _serving_weight_args(quantization, "vllm")
+    vllm_kwargs = {"dtype": dtype}
+    if method == "bitsandbytes":
+        vllm_kwargs.update(quantization=method, load_format=method)
+    elif method is not None:
+        vllm_kwargs.update(quantization=method)
+    
+    llm = LLM(
+        model=model_id,
+        download_dir=models_dir,
+        trust_remote_code=True,
+        max_num_batched_tokens=8192,
+        # Every prompt starts with the same long system prompt; reuse its KV blocks
+        enable_prefix_caching=True,
+        **vllm_kwargs
+    )
+    return llm, llm.get_tokenizer()
+
+
+def _start_server(model_id: str, models_dir: str, quantization: str, backend: str,
+                  local_files_only: bool) -> Tuple[Any, Any]:
+    """Serve a model from a vLLM or SGLang server subprocess; returns (server, tokenizer)"""
+    dtype, method = _serving_weight_args(quantization, backend)
+    server_cls = SGLangServer if backend == "sglang" else VLLMServer
+    server = server_cls(model_id, models_dir=models_dir, dtype=dtype, quantization=method)
+    tokenizer = AutoTokenizer.from_pretrained(
+        model_id,
+        use_fast=True,
+        trust_remote_code=True,
+        cache_dir=models_dir,
+        local_files_only=local_files_only
+    )
+    return server, tokenizer
+
+
+def clear_model_cache(keep: Union[str, Sequence[str], None] = None):
+    """
+    Drop cached models and release their GPU memory.
+    
+    Called once before loading the next model rather than after every task,
+    since emptying the CUDA cache is a synchronous, device-wide stall.
+    
+    Args:
+        keep: Optional model ID (or IDs) whose cached copies are kept
+    """
+    if isinstance(keep, str):
+        keep = (keep,)
+    keep = tuple(keep or ())
+    
+    # Snapshot the keys: a background preload may add entries while we iterate
+    dropped = [key for key in list(_MODEL_CACHE) if key[0] not in keep]
+    for key in dropped:
+        model, _ = _MODEL_CACHE.pop(key)
+        for engine in _BATCHING_ENGINES.pop(model, []):
+            engine.close()
+        if isinstance(model, OpenAIServer):
+            model.stop()
+    
+    if dropped and torch.cuda.is_available():
+        gc.collect()
+        torch.cuda.empty_cache()
 
 
 class BaseAgent:
     """Base class for all agents"""
     
-    def __init__(self, model_id: str, models_dir: str = "./models", device: Optional[str] = None):
-        """Initialize agent with model"""
+    # Generation budget and sampling temperature used by process()/process_batch()
+    max_new_tokens = 256
+    temperature = 0.7
+    # Optional strings that end a response as soon as they are generated
+    stop_strings: Optional[Tuple[str, ...]] = None
+    
+    def __init__(self, model_id: str, models_dir: str = "./models", device: Optional[str] = None,
+                 quantization: str = "auto", backend: str = "eager",
+                 model_and_tokenizer: Optional[Tuple[Any, Any]] = None):
+        """
+        Initialize agent with model.
+        
+        Args:
+            model_id: HuggingFace model ID
+            models_dir: Model cache directory
+            device: Target device (defaults to CUDA when available)
+            quantization: Weight precision/quantization mode (see QUANTIZATION_MODES)
+            backend: Inference backend (see BACKENDS)
+            model_and_tokenizer: Optional preloaded (model, tokenizer) pair to share;
+                otherwise the process-wide model cache is used
+        """
         self.model_id = model_id
         self.models_dir = models_dir
+        self.quantization = quantization
+        self.backend = backend
         
         if device is None:
             device = "cuda" if torch.cuda.is_available() else "cpu"
         self.device = device
         
-        os.environ["HF_HOME"] = models_dir
-        os.environ["TRANSFORMERS_CACHE"] = models_dir
-        
         print(f"Loading {self.__class__.__name__}: {model_id}")
         
-        self.tokenizer = AutoTokenizer.from_pretrained(
-            model_id,
-            trust_remote_code=True,
-            cache_dir=models_dir
-        )
+        if model_and_tokenizer is None:
+            model_and_tokenizer = load_model(model_id, models_dir, device, quantization, backend)
+        self.model, self.tokenizer = model_and_tokenizer
+        # Special token ids passed to every generate call (load_model sets the pad token)
+        self.pad_id = self.tokenizer.pad_token_id
+        self.eos_id = self.tokenizer.eos_token_id
+        self._generate_lock = _generate_lock(self.model)
+        self.context_length = self._context_length()
+        
+        # Static prompt prefix -> (prefix token ids, KV cache for those ids)
+        self._prefix_cache: Dict[str, Tuple[torch.Tensor, DynamicCache]] = {}
+        # Static prompt prefix -> whether prefix ids + separately encoded suffix
+        # reproduce the tokenization of the full prompt (checked on first use)
+        self._prefix_valid: Dict[str, bool] = {}
+        
+        # (instruction key, context) -> token ids of the prompt before and after the input
+        # (None when the input does not start a line and must be tokenized in place)
+        self._segment_ids: Dict[Tuple[Optional[str], str], Optional[Tuple[List[int], List[int]]]] = {}
+        self._separator_ids: Optional[List[int]] = None
+        
+        # Optional prompt -> response cache, see enable_prompt_cache()
+        self.prompt_cache: Optional[PromptCache] = None
+        
+        # Optional draft model for speculative decoding, see enable_speculative_decoding()
+        self.assistant_model = None
+        
+        # Optional queue coalescing concurrent generate calls, see enable_request_batching()
+        self.batching_engine: Optional[BatchingEngine] = None
+        self._owns_batching_engine = False
+        
+        # Conversation id -> (token ids so far, KV cache for them, CUDA event the KV
+        # is ready after or None), see generate_turn(); the KV is a DynamicCache, or
+        # per-layer (key, value) host tensors while offloaded (see enable_kv_offload())
+        self.conversations = ConversationCache()
+        self._offload_stream = None
+    
+    @classmethod
+    def from_shared(cls, model_id: str, models_dir: str = "./models", device: Optional[str] = None,
+                    quantization: str = "auto", backend: str = "eager"):
+        """
+        Create an agent on the process-wide copy of a model, loading it only if
+        no other agent has. Agents differ only in task and prompts, so e.g.
+        NLQAgent.from_shared(m) and SQLAgent.from_shared(m) hold one set of weights.
+        """
+        model_and_tokenizer = load_model(model_id, models_dir, device, quantization, backend)
+        return cls(model_id, models_dir, device, quantization, backend,
+                   model_and_tokenizer=model_and_tokenizer)
+    
+    def enable_prompt_cache(self, semantic_threshold: Optional[float] = None,
+                            db_path: str = "./results/prompt_cache.sqlite") -> PromptCache:
+        """
+        Serve repeated prompts from a cache instead of calling generate.
+        Entries are keyed by model, quantization, backend, task, stop strings and
+        generation parameters; sampled generations (temperature > 0) bypass the cache.
         
-        if self.tokenizer.pad_token is None:
-            self.tokenizer.pad_token = self.tokenizer.eos_token
+        Args:
+            semantic_threshold: Optional cosine similarity for near-duplicate hits
+            db_path: SQLite file the cache is persisted to
         
-        self.model = AutoModelForCausalLM.from_pretrained(
-            model_id,
-            torch_dtype="auto",
-            device_map="auto" if self.device == "cuda" else self.device,
-            trust_remote_code=True,
-            cache_dir=models_dir,
-            attn_implementation="flash_attention_2" if self.device == "cuda" else None
+        Returns:
+            The agent's PromptCache
+        """
+        if self.temperature > 0:
+            print(f"{self.__class__.__name__} samples (temperature={self.temperature}); "
+                  "its generations will not be cached")
+        self.prompt_cache = PromptCache(
+            self.model_id,
+            self.task,
+            quantization=self.quantization,
+            backend=self.backend,
+            stop_strings=self.stop_strings,
+            db_path=db_path,
+            semantic_threshold=semantic_threshold
         )
+        return self.prompt_cache
+    
+    def enable_request_batching(self, max_batch_size: int = 32, max_wait: float = 0.005,
+                                engine: Optional[BatchingEngine] = None) -> BatchingEngine:
+        """
+        Coalesce generate() calls made concurrently from several threads into
+        batched generate calls, for agents serving many users at once.
+        
+        Args:
+            max_batch_size: Most prompts generated together
+            max_wait: Seconds a request waits for others to join its batch
+            engine: Existing engine to share, e.g. another agent's on the same model;
+                each request carries the submitting agent's stop strings and temperature
+        
+        Returns:
+            The agent's BatchingEngine
+        """
+        owned = engine is None
+        if owned:
+            engine = BatchingEngine(self._generate_batch, max_batch_size, max_wait)
+            with _GENERATE_LOCKS_GUARD:
+                _BATCHING_ENGINES.setdefault(self.model, []).append(engine)
+        elif getattr(getattr(engine.generate_fn, "__self__", None), "model", self.model) is not self.model:
+            raise ValueError("A shared BatchingEngine must generate with this agent's model")
+        self.close()
+        self.batching_engine = engine
+        self._owns_batching_engine = owned
+        return engine
+    
+    def close(self):
+        """Stop the agent's own BatchingEngine worker; shared engines are left to their owner"""
+        if self.batching_engine is not None and self._owns_batching_engine:
+            self.batching_engine.close()
+        self.batching_engine = None
+        self._owns_batching_engine = False
+    
+    def enable_kv_offload(self) -> bool:
+        """
+        Keep idle conversation KV caches in pinned host memory instead of VRAM.
+        After each turn the cache is copied out on a side CUDA stream, and it is
+        copied back (on the same stream) when the conversation's next turn starts
+        or when prefetch_conversation() is called.
+        
+        Returns:
+            Whether offloading was enabled (CUDA models only)
+        """
+        if self.backend in SERVING_BACKENDS or self.model.device.type != "cuda":
+            print("KV cache offloading needs an HF model on a CUDA device")
+            return False
+        self._offload_stream = torch.cuda.Stream(device=self.model.device)
+        return True
+    
+    def enable_speculative_decoding(self, draft_model_id: str) -> bool:
+        """
+        Verify tokens proposed by a small draft model instead of decoding every
+        token with this agent's model. Only enabled for targets of at least
+        SPECULATIVE_MIN_PARAMETERS on the eager backend; assisted generation
+        decodes one sequence at a time, so batched calls of more than one
+        prompt keep plain decoding.
+        
+        Args:
+            draft_model_id: HuggingFace model ID sharing this model's tokenizer
+        
+        Returns:
+            Whether speculative decoding was enabled
+        """
+        if self.backend != "eager":
+            print(f"Speculative decoding is not supported by the {self.backend} backend")
+            return False
+        if self.model.num_parameters() < SPECULATIVE_MIN_PARAMETERS:
+            print(f"Skipping draft model {draft_model_id}: target is below "
+                  f"{SPECULATIVE_MIN_PARAMETERS / 1e9:.0f}B parameters")
+            return False
+        
+        self.assistant_model, _ = load_model(draft_model_id, self.models_dir, self.device)
+        return True
+    
+    def _assistant_kwargs(self, batch_size: int) -> Dict:
+        """generate() arguments for speculative decoding, when it applies"""
+        if self.assistant_model is None or batch_size != 1:
+            return {}
+        return {"assistant_model": self.assistant_model, "num_assistant_tokens": NUM_ASSISTANT_TOKENS}
+    
+    def generate(self, prompt: Union[str, torch.Tensor], max_length: int = 256, temperature: float = 0.7,
+                 prefix: Optional[str] = None, input_text: Optional[str] = None) -> str:
+        """
+        Generate response from prompt.
+        
+        Args:
+            prompt: Full prompt text, or its token ids (1-D or a single row),
+                which skips tokenization and the prompt cache
+            max_length: Maximum number of new tokens
+            temperature: Sampling temperature
+            prefix: Optional static start of the prompt shared across calls;
+                its KV cache is computed once and reused so only the rest
+                of the prompt is prefilled
+            input_text: Optional user input inside the prompt, used by the
+                prompt cache for semantic matches
+        """
+        if isinstance(prompt, torch.Tensor):
+            input_ids = prompt.reshape(1, -1)
+            return self.generate_from_ids(input_ids, torch.ones_like(input_ids), max_length, temperature)[0]
+        
+        if self.prompt_cache is not None:
+            return self.prompt_cache.get_or_compute(
+                prompt,
+                lambda: self._generate(prompt, max_length, temperature, prefix),
+                max_length,
+                temperature,
+                input_text
+            )
+        return self._generate(prompt, max_length, temperature, prefix)
+    
+    def _generate(self, prompt: str, max_length: int, temperature: float,
+                  prefix: Optional[str]) -> str:
+        """Uncached generate"""
+        if self.batching_engine is not None:
+            return self.batching_engine.generate(prompt, max_length, temperature, self.stop_strings)
+        
+        if self.backend in SERVING_BACKENDS:
+            return self._generate_served([prompt], max_length, temperature, self.stop_strings)[0]
+        
+        # A precomputed DynamicCache prefix cannot be combined with a static cache,
+        # and the draft model would need a prefix cache of its own
+        if (prefix and prompt.startswith(prefix) and not self._uses_static_cache()
+                and self.assistant_model is None):
+            response = self._generate_with_prefix(prompt, prefix, max_length, temperature)
+            if response is not None:
+                return response
+        
+        # Pinned host tensors let the copy to the device run asynchronously
+        inputs = {
+            name: tensor.to(self.model.device, non_blocking=True)
+            for name, tensor in self._tokenize_prompt(prompt, self._max_input_tokens(max_length)).items()
+        }
+        
+        with self._generate_lock, torch.inference_mode():
+            outputs = self.model.generate(
+                **inputs,
+                max_new_tokens=max_length,
+                **self._sampling_kwargs(temperature),
+                pad_token_id=self.pad_id,
+                eos_token_id=self.eos_id,
+                **self._stop_kwargs(self.stop_strings),
+                **self._assistant_kwargs(1)
+            )
         
-        self.model.eval()
+        # Decode only the generated tokens; matching the decoded prompt text back out
+        # of the response breaks whenever decoding does not round-trip the prompt
+        return self.tokenizer.decode(
+            outputs[0, inputs["input_ids"].shape[1]:], skip_special_tokens=True
+        ).strip()
     
-    def generate(self, prompt: str, max_length: int = 256, temperature: float = 0.7) -> str:
-        """Generate response from prompt"""
+    def _tokenize_prompt(self, prompt: str, max_input_tokens: int) -> Dict[str, torch.Tensor]:
+        """Tokenize one prompt into CPU tensors (pinned for GPU models)"""
         inputs = self.tokenizer(
             prompt,
             return_tensors="pt",
             truncation=True,
-            max_length=512
-        ).to(self.model.device)
+            max_length=max_input_tokens,
+            **self._padding_kwargs()
+        )
+        if self.model.device.type == "cuda":
+            return {name: tensor.pin_memory() for name, tensor in inputs.items()}
+        return dict(inputs)
+    
+    def _generate_with_prefix(self, prompt: str, prefix: str, max_length: int,
+                              temperature: float) -> Optional[str]:
+        """
+        Generate reusing the cached prefix KV; returns None if the prompt would be
+        truncated, the prefix does not end a line (see _encode_continuations) or the
+        split tokenization does not match the full prompt's
+        """
+        # Encoded on its own, the suffix would get a leading-space token from
+        # SentencePiece tokenizers that the full prompt does not have
+        if not prefix.endswith("\n") or self._prefix_valid.get(prefix) is False:
+            return None
+        prefix_ids, prefix_kv = self._get_prefix_cache(prefix)
+        suffix = self._encode_continuations([prompt[len(prefix):]])[0]
+        
+        # Merges across the line break or special tokens the tokenizer adds differently
+        # would feed the model ids it never sees without the cache
+        if prefix not in self._prefix_valid:
+            self._prefix_valid[prefix] = (
+                prefix_ids[0].tolist() + suffix == self.tokenizer(prompt).input_ids
+            )
+            if not self._prefix_valid[prefix]:
+                return None
         
-        with torch.no_grad():
+        suffix_ids = torch.tensor([suffix], dtype=torch.long).to(self.model.device)
+        
+        input_ids = torch.cat([prefix_ids, suffix_ids], dim=1)
+        if input_ids.shape[1] > self._max_input_tokens(max_length):
+            return None
+        
+        with self._generate_lock, torch.inference_mode():
+            outputs = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                # generate() appends to the cache, so each call gets its own copy
+                past_key_values=copy.deepcopy(prefix_kv),
+                max_new_tokens=max_length,
+                **self._sampling_kwargs(temperature),
+                pad_token_id=self.pad_id,
+                eos_token_id=self.eos_id,
+                **self._stop_kwargs(self.stop_strings)
+            )
+        
+        return self.tokenizer.decode(outputs[0, input_ids.shape[1]:], skip_special_tokens=True).strip()
+    
+    def _generate_served(self, prompts: List[str], max_length: int, temperature: float,
+                         stop_strings: Optional[Sequence[str]]) -> List[str]:
+        """Submit all prompts to the serving engine at once and let its scheduler batch them"""
+        if isinstance(self.model, OpenAIServer):
+            return self.model.generate(prompts, max_tokens=max_length, temperature=temperature,
+                                       stop=stop_strings)
+        
+        from vllm import SamplingParams
+        
+        sampling_params = SamplingParams(
+            temperature=temperature,
+            top_p=0.95,
+            max_tokens=max_length,
+            stop=list(stop_strings) if stop_strings else None,
+            include_stop_str_in_output=True
+        )
+        # vllm.LLM is not thread-safe; agents sharing it take turns
+        with self._generate_lock:
+            outputs = self.model.generate(prompts, sampling_params, use_tqdm=False)
+        
+        return [output.outputs[0].text.strip() for output in outputs]
+    
+    @staticmethod
+    def _sampling_kwargs(temperature: float) -> Dict:
+        """generate() decoding arguments; a temperature of 0 means plain greedy decoding"""
+        if temperature <= 0:
+            # Clearing the checkpoint's sampling defaults keeps generate from
+            # building temperature/top-p processors that greedy decoding ignores
+            return {"do_sample": False, "num_beams": 1, "temperature": None, "top_p": None,
+                    "use_cache": True}
+        return {"do_sample": True, "temperature": temperature, "top_p": 0.95, "use_cache": True}
+    
+    def _context_length(self) -> int:
+        """Tokens the model can attend to (prompt plus generation), capped at MAX_CONTEXT_TOKENS"""
+        limits = [MAX_CONTEXT_TOKENS]
+        config = getattr(self.model, "config", None)
+        if getattr(config, "max_position_embeddings", None):
+            limits.append(config.max_position_embeddings)
+        # Tokenizers without a known limit report a huge sentinel value
+        if self.tokenizer.model_max_length < 1_000_000:
+            limits.append(self.tokenizer.model_max_length)
+        return min(limits)
+    
+    def _max_input_tokens(self, max_new_tokens: int) -> int:
+        """Longest prompt that still leaves room for max_new_tokens"""
+        return max(self.context_length - max_new_tokens, 1)
+    
+    def _stop_kwargs(self, stop_strings: Optional[Sequence[str]]) -> Dict:
+        """generate() arguments ending each sequence at the given stop strings"""
+        if not stop_strings:
+            return {}
+        return {"stop_strings": list(stop_strings), "tokenizer": self.tokenizer}
+    
+    def _uses_static_cache(self) -> bool:
+        """Whether the model generates with a static (compile-friendly) KV cache"""
+        return self.model.generation_config.cache_implementation == "static"
+    
+    def _padding_kwargs(self, batched: bool = False) -> Dict:
+        """Tokenizer padding arguments; compiled models get length-bucketed inputs"""
+        if self._uses_static_cache():
+            return {"padding": True, "pad_to_multiple_of": COMPILE_PAD_MULTIPLE}
+        return {"padding": True} if batched else {}
+    
+    def _batch_prefix(self, custom_instruction_key: Optional[str],
+                      context: str) -> Optional[Tuple[torch.Tensor, DynamicCache]]:
+        """(token ids, KV cache) of the prompt start shared by a whole batch, if it can be reused"""
+        # Same restrictions as the single-prompt prefix path in _generate
+        if self._uses_static_cache() or self.assistant_model is not None:
+            return None
+        
+        segment_ids = self._get_segment_ids(custom_instruction_key, context)
+        prefix = self._prompt_prefix(custom_instruction_key)
+        if segment_ids is None or prefix is None:
+            return None
+        
+        prefix_ids, prefix_kv = self._get_prefix_cache(prefix)
+        # Only reuse the KV if it covers exactly the tokens every prompt starts with,
+        # and leaves room for the rest of the prompt before truncation
+        if (prefix_ids[0].tolist() != segment_ids[0]
+                or prefix_ids.shape[1] >= self._max_input_tokens(self.max_new_tokens)):
+            return None
+        return prefix_ids, prefix_kv
+    
+    def warm_prefix_cache(self, custom_instruction_key: Optional[str] = None) -> bool:
+        """
+        Prefill the KV cache of the instruction's static prompt prefix now rather
+        than on the first request.
+        
+        Returns:
+            Whether a prefix KV cache is available for the instruction
+        """
+        # Same restrictions as the prefix paths in _generate and _batch_prefix
+        if (self.backend in SERVING_BACKENDS or self._uses_static_cache()
+                or self.assistant_model is not None):
+            return False
+        prefix = self._prompt_prefix(custom_instruction_key)
+        if not prefix:
+            return False
+        self._get_prefix_cache(prefix)
+        return True
+    
+    def _get_prefix_cache(self, prefix: str) -> Tuple[torch.Tensor, DynamicCache]:
+        """Get (token ids, KV cache) for a static prompt prefix, prefilling it on first use"""
+        if prefix not in self._prefix_cache:
+            prefix_ids = self.tokenizer(prefix, return_tensors="pt").input_ids.to(self.model.device)
+            with self._generate_lock, torch.inference_mode():
+                outputs = self.model(prefix_ids, past_key_values=DynamicCache(), use_cache=True)
+            self._prefix_cache[prefix] = (prefix_ids, outputs.past_key_values)
+        return self._prefix_cache[prefix]
+    
+    def generate_batch(self, prompts: List[str], max_length: int = 256,
+                       temperature: float = 0.7, input_texts: Optional[List[str]] = None) -> List[str]:
+        """
+        Generate responses for several prompts in a single padded forward pass.
+        input_texts are the optional user inputs inside the prompts (see generate).
+        """
+        if self.prompt_cache is not None:
+            return self.prompt_cache.get_or_compute_batch(
+                prompts,
+                lambda missing: self._generate_batch(missing, max_length, temperature, self.stop_strings),
+                max_length,
+                temperature,
+                input_texts
+            )
+        return self._generate_batch(prompts, max_length, temperature, self.stop_strings)
+    
+    def _generate_batch(self, prompts: List[str], max_length: int, temperature: float,
+                        stop_strings: Optional[Sequence[str]]) -> List[str]:
+        """
+        Uncached generate_batch. The stop strings are a parameter rather than read
+        from the agent, since a shared BatchingEngine runs other agents' requests here.
+        """
+        if self.backend in SERVING_BACKENDS:
+            return self._generate_served(prompts, max_length, temperature, stop_strings)
+        
+        return self._generate_from_inputs(self._tokenize_batch(prompts, max_length), max_length,
+                                          temperature, stop_strings)
+    
+    def _tokenize_batch(self, prompts: List[str], max_new_tokens: int) -> Dict[str, torch.Tensor]:
+        """Tokenize prompts into padded CPU tensors, pinned when they will be copied to a GPU"""
+        inputs = self.tokenizer(
+            prompts,
+            return_tensors="pt",
+            truncation=True,
+            max_length=self._max_input_tokens(max_new_tokens),
+            **self._padding_kwargs(batched=True)
+        )
+        if self.model.device.type == "cuda":
+            return {name: tensor.pin_memory() for name, tensor in inputs.items()}
+        return dict(inputs)
+    
+    def _pad_batch(self, prompt_ids: List[List[int]]) -> Dict[str, torch.Tensor]:
+        """Pad pre-tokenized prompts into CPU tensors, pinned when they will be copied to a GPU"""
+        inputs = self.tokenizer.pad(
+            {"input_ids": prompt_ids},
+            return_tensors="pt",
+            **self._padding_kwargs(batched=True)
+        )
+        if self.model.device.type == "cuda":
+            return {name: tensor.pin_memory() for name, tensor in inputs.items()}
+        return dict(inputs)
+    
+    def generate_from_ids(self, input_ids: torch.Tensor, attention_mask: torch.Tensor,
+                          max_length: int = 256, temperature: float = 0.7) -> List[str]:
+        """Generate responses for already tokenized, left-padded prompts, skipping tokenization"""
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        return self._generate_from_inputs(inputs, max_length, temperature, self.stop_strings)
+    
+    def _generate_from_inputs(self, inputs: Dict[str, torch.Tensor], max_length: int,
+                              temperature: float, stop_strings: Optional[Sequence[str]],
+                              prefix: Optional[Tuple[torch.Tensor, DynamicCache]] = None,
+                              cancel_event: Optional[threading.Event] = None) -> List[str]:
+        """
+        Run one batched generate on tokenized inputs and decode the new tokens.
+        
+        With a (prefix ids, prefix KV) pair, inputs hold only the text after the
+        prefix; the prefix KV is shared by every row instead of being prefilled again.
+        Setting cancel_event stops the generation after its current decoding step.
+        """
+        # Pinned host tensors let the copy to the device run asynchronously
+        inputs = {
+            name: tensor.to(self.model.device, non_blocking=True)
+            for name, tensor in inputs.items()
+        }
+        
+        cache_kwargs = {}
+        if prefix is not None:
+            prefix_ids, prefix_kv = prefix
+            batch_size = inputs["input_ids"].shape[0]
+            # Padding now sits between prefix and suffix; the attention mask hides
+            # it and position ids are derived from the mask, so positions stay exact
+            inputs["input_ids"] = torch.cat(
+                [prefix_ids.expand(batch_size, -1), inputs["input_ids"]], dim=1
+            )
+            inputs["attention_mask"] = torch.cat(
+                [torch.ones_like(prefix_ids).expand(batch_size, -1), inputs["attention_mask"]], dim=1
+            )
+            # generate() appends to the cache, so each call gets its own copy
+            past_key_values = copy.deepcopy(prefix_kv)
+            past_key_values.batch_repeat_interleave(batch_size)
+            cache_kwargs["past_key_values"] = past_key_values
+        if cancel_event is not None:
+            cache_kwargs["stopping_criteria"] = StoppingCriteriaList([_CancelCriteria(cancel_event)])
+        
+        with self._generate_lock, torch.inference_mode():
             outputs = self.model.generate(
                 **inputs,
+                **cache_kwargs,
+                max_new_tokens=max_length,
+                **self._sampling_kwargs(temperature),
+                pad_token_id=self.pad_id,
+                eos_token_id=self.eos_id,
+                **self._stop_kwargs(stop_strings),
+                **self._assistant_kwargs(inputs["input_ids"].shape[0])
+            )
+        
+        # Left padding puts every prompt at the same offset, so the
+        # generated tokens all start at the padded input length
+        new_tokens = outputs[:, inputs["input_ids"].shape[1]:]
+        responses = self.tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+        
+        return [response.strip() for response in responses]
+    
+    def process_batch(self, input_texts: List[str], custom_instruction_key: Optional[str] = None,
+                      context: str = "") -> List[Dict]:
+        """
+        Process several inputs with one batched generate call.
+        
+        Args:
+            input_texts: Inputs to process
+            custom_instruction_key: Optional custom instruction key
+            context: Optional context shared by every input
+        
+        Returns:
+            List of result dictionaries, in input order
+        """
+        prompts = [
+            self._build_prompt(text, custom_instruction_key, context)
+            for text in input_texts
+        ]
+        responses = self.generate_batch(prompts, max_length=self.max_new_tokens,
+                                        temperature=self.temperature, input_texts=input_texts)
+        
+        return [
+            self._build_result(text, response)
+            for text, response in zip(input_texts, responses)
+        ]
+    
+    def process_stream(self, input_texts: List[str], batch_size: int,
+                       custom_instruction_key: Optional[str] = None,
+                       context: str = "") -> Iterator[Tuple[List[str], List[Dict], float]]:
+        """
+        Process inputs batch by batch. All inputs are tokenized once up front;
+        upcoming batches are padded on a worker thread while the current
+        batch is generating.
+        
+        Args:
+            input_texts: Inputs to process
+            batch_size: Number of inputs per generate call
+            custom_instruction_key: Optional custom instruction key
+            context: Optional context shared by every input
+        
+        Yields:
+            (batch inputs, batch results, batch wall time in seconds)
+        """
+        batches = [
+            input_texts[start:start + batch_size]
+            for start in range(0, len(input_texts), batch_size)
+        ]
+        
+        if not batches:
+            return
+        
+        # Serving engines tokenize internally and cached prompts may skip generation entirely
+        if self.backend in SERVING_BACKENDS or self.prompt_cache is not None:
+            for batch in batches:
+                batch_start = time.time()
+                batch_results = self.process_batch(batch, custom_instruction_key, context)
+                yield batch, batch_results, time.time() - batch_start
+            return
+        
+        # Prefill the shared prompt prefix once for every batch
+        prefix = self._batch_prefix(custom_instruction_key, context)
+        prefix_length = prefix[0].shape[1] if prefix is not None else 0
+        
+        # Every input is tokenized up front in one batched call; the worker only pads
+        prompt_ids = [
+            ids[prefix_length:]
+            for ids in self._encode_prompts(input_texts, custom_instruction_key, context)
+        ]
+        batch_ids = [
+            prompt_ids[start:start + batch_size]
+            for start in range(0, len(prompt_ids), batch_size)
+        ]
+        
+        # One worker is enough: padding a batch is cheap next to generating it
+        with ThreadPoolExecutor(max_workers=1) as padding_pool:
+            # Keep up to two batches padded ahead of the one being generated
+            pending = deque(padding_pool.submit(self._pad_batch, ids) for ids in batch_ids[:2])
+            
+            for idx, batch in enumerate(batches):
+                batch_start = time.time()
+                inputs = pending.popleft().result()
+                if idx + 2 < len(batches):
+                    pending.append(padding_pool.submit(self._pad_batch, batch_ids[idx + 2]))
+                
+                responses = self._generate_from_inputs(inputs, self.max_new_tokens,
+                                                       self.temperature, self.stop_strings, prefix)
+                batch_results = [
+                    self._build_result(text, response)
+                    for text, response in zip(batch, responses)
+                ]
+                yield batch, batch_results, time.time() - batch_start
+    
+    def generate_turn(self, conversation_id: str, prompt: str, followup_prompt: Optional[str] = None,
+                      max_length: int = 256, temperature: float = 0.7) -> str:
+        """
+        Generate the next turn of a conversation. The KV cache of all earlier turns
+        (prompts and responses) is kept between calls, so a turn only prefills its
+        own prompt. Conversations are dropped after self.conversations' TTL, when
+        evicted, or once the history no longer fits the context window.
+        
+        Args:
+            conversation_id: Conversation the turn belongs to
+            prompt: Full prompt, used for a conversation's first turn
+            followup_prompt: Optional shorter prompt for later turns (e.g. without the
+                system prompt the history already contains); defaults to prompt
+            max_length: Maximum number of new tokens
+            temperature: Sampling temperature
+        """
+        # The history is a DynamicCache; static caches and assisted generation keep their own
+        if (self.backend in SERVING_BACKENDS or self._uses_static_cache()
+                or self.assistant_model is not None):
+            return self.generate(prompt, max_length, temperature)
+        
+        state = self.conversations.get(conversation_id)
+        if state is not None:
+            history_ids = state[0]
+            past_key_values = self._conversation_kv(state)
+            turn_ids = self.tokenizer(
+                "\n\n" + (followup_prompt or prompt),
+                return_tensors="pt",
+                add_special_tokens=False
+            ).input_ids.to(self.model.device)
+            input_ids = torch.cat([history_ids, turn_ids], dim=1)
+            if input_ids.shape[1] > self._max_input_tokens(max_length):
+                state = None
+        
+        if state is None:
+            input_ids = self.tokenizer(
+                prompt,
+                return_tensors="pt",
+                truncation=True,
+                max_length=self._max_input_tokens(max_length)
+            ).input_ids.to(self.model.device)
+            past_key_values = DynamicCache()
+        
+        with self._generate_lock, torch.inference_mode():
+            outputs = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                # Covers the earlier turns, so only the new tokens are prefilled
+                past_key_values=past_key_values,
                 max_new_tokens=max_length,
-                temperature=temperature,
-                top_p=0.95,
-                do_sample=True,
-                pad_token_id=self.tokenizer.pad_token_id,
-                eos_token_id=self.tokenizer.eos_token_id
+                **self._sampling_kwargs(temperature),
+                pad_token_id=self.pad_id,
+                eos_token_id=self.eos_id,
+                **self._stop_kwargs(self.stop_strings),
+                return_dict_in_generate=True
+            )
+        
+        past_key_values = outputs.past_key_values
+        if self._offload_stream is not None:
+            past_key_values = self._offload_kv(past_key_values)
+        self.conversations.put(conversation_id, (outputs.sequences, past_key_values, None))
+        return self.tokenizer.decode(
+            outputs.sequences[0, input_ids.shape[1]:], skip_special_tokens=True
+        ).strip()
+    
+    def end_conversation(self, conversation_id: str):
+        """Release the KV cache kept for a conversation"""
+        self.conversations.pop(conversation_id)
+    
+    def prefetch_conversation(self, conversation_id: str):
+        """Start copying an offloaded conversation KV cache back to the GPU without waiting for it"""
+        state = self.conversations.get(conversation_id)
+        if state is None or isinstance(state[1], DynamicCache):
+            return
+        past_key_values, ready = self._restore_kv(state[1])
+        self.conversations.put(conversation_id, (state[0], past_key_values, ready))
+    
+    def _conversation_kv(self, state: Tuple) -> DynamicCache:
+        """The GPU KV cache of a stored conversation, waiting for any copy still in flight"""
+        _, past_key_values, ready = state
+        if not isinstance(past_key_values, DynamicCache):
+            past_key_values, ready = self._restore_kv(past_key_values)
+        if ready is not None:
+            torch.cuda.current_stream(self.model.device).wait_event(ready)
+        return past_key_values
+    
+    def _offload_kv(self, past_key_values: DynamicCache) -> Tuple[Tuple[torch.Tensor, torch.Tensor], ...]:
+        """Copy a KV cache into pinned host memory on the side stream"""
+        stream = self._offload_stream
+        stream.wait_stream(torch.cuda.current_stream(self.model.device))
+        host_layers = []
+        with torch.cuda.stream(stream):
+            for layer in past_key_values.to_legacy_cache():
+                host_layer = []
+                for tensor in layer:
+                    host_tensor = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+                    host_tensor.copy_(tensor, non_blocking=True)
+                    # The GPU block is only reused once the copy on the side stream has run
+                    tensor.record_stream(stream)
+                    host_layer.append(host_tensor)
+                host_layers.append(tuple(host_layer))
+        return tuple(host_layers)
+    
+    def _restore_kv(self, host_layers: Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+                    ) -> Tuple[DynamicCache, torch.cuda.Event]:
+        """Copy an offloaded KV cache back on the side stream; returns it with its ready event"""
+        stream = self._offload_stream
+        with torch.cuda.stream(stream):
+            layers = tuple(
+                tuple(tensor.to(self.model.device, non_blocking=True) for tensor in layer)
+                for layer in host_layers
             )
+            ready = torch.cuda.Event()
+            ready.record(stream)
+        # The tensors are used (and later freed) on the compute stream
+        compute_stream = torch.cuda.current_stream(self.model.device)
+        for layer in layers:
+            for tensor in layer:
+                tensor.record_stream(compute_stream)
+        return DynamicCache.from_legacy_cache(layers), ready
+    
+    def _generate_for_input(self, input_text: str, custom_instruction_key: Optional[str] = None,
+                            context: str = "", conversation_id: Optional[str] = None,
+                            cancel_event: Optional[threading.Event] = None) -> str:
+        """
+        Response for one input. On HF backends the prompt is assembled from cached
+        token segments (template and context tokenized once, only the input per call)
+        instead of building and tokenizing the full prompt string. With a
+        conversation_id the input is a turn of that conversation, see generate_turn().
+        cancel_event is only honoured when supports_cancellation() is true.
+        """
+        if conversation_id is not None:
+            instruction = self._instruction(custom_instruction_key)
+            if instruction is not None:
+                system_prompt, followup_prompt = instruction.render_prompt(input_text, context)
+                prompt = f"{system_prompt}\n\n{followup_prompt}"
+            else:
+                prompt, followup_prompt = self._get_default_prompt(input_text, context), None
+            return self.generate_turn(
+                conversation_id,
+                prompt,
+                followup_prompt=followup_prompt,
+                max_length=self.max_new_tokens,
+                temperature=self.temperature
+            )
+        
+        # Serving engines, the prompt cache and the batching engine all work on prompt text
+        if (self.backend in SERVING_BACKENDS or self.prompt_cache is not None
+                or self.batching_engine is not None):
+            return self.generate(
+                self._build_prompt(input_text, custom_instruction_key, context),
+                max_length=self.max_new_tokens,
+                temperature=self.temperature,
+                prefix=self._prompt_prefix(custom_instruction_key),
+                input_text=input_text
+            )
+        
+        prefix = self._batch_prefix(custom_instruction_key, context)
+        prefix_length = prefix[0].shape[1] if prefix is not None else 0
+        prompt_ids = self._encode_prompts([input_text], custom_instruction_key, context)[0][prefix_length:]
+        
+        return self._generate_from_inputs(
+            self._pad_batch([prompt_ids]), self.max_new_tokens, self.temperature,
+            self.stop_strings, prefix, cancel_event
+        )[0]
+    
+    def supports_cancellation(self) -> bool:
+        """Whether process() can stop a running generation through a cancel event"""
+        return (self.backend not in SERVING_BACKENDS and self.prompt_cache is None
+                and self.batching_engine is None)
+    
+    def _build_prompt(self, input_text: str, custom_instruction_key: Optional[str] = None,
+                      context: str = "") -> str:
+        """Build the full prompt for an input"""
+        instruction = self._instruction(custom_instruction_key)
+        if instruction is None:
+            return self._get_default_prompt(input_text, context)
+        system_prompt, user_prompt = instruction.render_prompt(input_text, context)
+        return f"{system_prompt}\n\n{user_prompt}"
+    
+    def _instruction(self, custom_instruction_key: Optional[str] = None) -> Optional[CustomInstruction]:
+        """Instruction prompts are built from: the custom one if registered, else the task's own"""
+        instruction = get_instruction(custom_instruction_key) if custom_instruction_key else None
+        return instruction or get_instruction(self.task)
+    
+    def _encode_prompts(self, input_texts: List[str], custom_instruction_key: Optional[str] = None,
+                        context: str = "") -> List[List[int]]:
+        """
+        Token ids of the prompts _build_prompt would produce, tokenizing only the inputs
+        (in one batched call); the surrounding template and context are tokenized
+        once per (key, context). Tokenizers for which the segments do not reproduce
+        full-prompt tokenization (see _segments_match) get the full prompts encoded.
+        """
+        max_input_tokens = self._max_input_tokens(self.max_new_tokens)
+        segment_ids = self._get_segment_ids(custom_instruction_key, context)
+        if segment_ids is None:
+            prompts = [
+                self._build_prompt(text, custom_instruction_key, context)
+                for text in input_texts
+            ]
+            return self.tokenizer(prompts, truncation=True, max_length=max_input_tokens).input_ids
         
-        response = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
+        head_ids, tail_ids = segment_ids
+        return [
+            (head_ids + input_ids + tail_ids)[:max_input_tokens]
+            for input_ids in self._encode_continuations(input_texts)
+        ]
+    
+    def _get_segment_ids(self, custom_instruction_key: Optional[str],
+                         context: str) -> Optional[Tuple[List[int], List[int]]]:
+        """Token ids of the prompt text before and after the input, computed on first use"""
+        key = (custom_instruction_key, context)
+        if key not in self._segment_ids:
+            template = self._build_prompt(_INPUT_MARKER, custom_instruction_key, context)
+            head, _, tail = template.partition(_INPUT_MARKER)
+            # Splitting mid-line would change how the input's first word is tokenized
+            if (not head.endswith("\n") or not tail.startswith("\n")
+                    or _INPUT_MARKER in tail):
+                self._segment_ids[key] = None
+            else:
+                self._segment_ids[key] = self._load_segment_ids(head, tail)
+        return self._segment_ids[key]
+    
+    def _load_segment_ids(self, head: str, tail: str) -> Tuple[List[int], List[int]]:
+        """
+        Token ids of the prompt segments around the input, persisted under
+        models_dir so the schema context in them is tokenized once per
+        tokenizer rather than once per run. None (also persisted) when the
+        segments do not reproduce full-prompt tokenization.
+        """
+        digest = hashlib.sha256(
+            "\0".join((self.tokenizer.name_or_path, str(len(self.tokenizer)), head, tail)).encode("utf-8")
+        ).hexdigest()
+        cache_file = Path(self.models_dir) / "token_cache" / f"segments_{digest[:32]}.pt"
         
-        if prompt in response:
-            response = response[len(prompt):].strip()
+        if cache_file.exists():
+            try:
+                segments = torch.load(cache_file, map_location="cpu", weights_only=True)
+                if not segments["valid"].item():
+                    return None
+                return segments["head"].tolist(), segments["tail"].tolist()
+            except Exception:
+                # Unreadable (e.g. partially written) cache files are simply rebuilt
+                pass
+        
+        head_ids = self.tokenizer(head).input_ids
+        tail_ids = self._encode_continuations([tail])[0]
+        valid = self._segments_match(head, tail, head_ids, tail_ids)
+        
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.with_name(cache_file.name + f".{os.getpid()}.tmp")
+        torch.save({"head": torch.tensor(head_ids, dtype=torch.long),
+                    "tail": torch.tensor(tail_ids, dtype=torch.long),
+                    "valid": torch.tensor(valid)}, tmp_file)
+        os.replace(tmp_file, cache_file)
+        return (head_ids, tail_ids) if valid else None
+    
+    def _segments_match(self, head: str, tail: str, head_ids: List[int], tail_ids: List[int]) -> bool:
+        """
+        Whether head + input + tail ids equal the ids of the full prompt for every
+        probe input. Byte-level BPE pretokenizers (Llama-3, Qwen2) merge trailing
+        punctuation with the newlines after it ("?\\n\\n" is one token), which
+        segment-wise encoding cannot reproduce.
+        """
+        full_ids = self.tokenizer([head + probe + tail for probe in _SEGMENT_PROBES]).input_ids
+        segment_ids = [
+            head_ids + input_ids + tail_ids
+            for input_ids in self._encode_continuations(list(_SEGMENT_PROBES))
+        ]
+        return full_ids == segment_ids
+    
+    def _encode_continuations(self, texts: List[str]) -> List[List[int]]:
+        """
+        Token ids for texts that each continue a prompt right after a line break.
+        
+        Tokenizers like SentencePiece add a leading-space token to text encoded on
+        its own, so each text is encoded after a newline and the newline's ids are dropped.
+        """
+        if self._separator_ids is None:
+            self._separator_ids = self.tokenizer("\n", add_special_tokens=False).input_ids
+        separator_length = len(self._separator_ids)
         
-        return response
+        encoded = self.tokenizer(["\n" + text for text in texts], add_special_tokens=False).input_ids
+        if all(ids[:separator_length] == self._separator_ids for ids in encoded):
+            return [ids[separator_length:] for ids in encoded]
+        # The newline merged into the text's first token (byte-level BPE),
+        # and such tokenizers add no leading space to begin with
+        return self.tokenizer(texts, add_special_tokens=False).input_ids
+    
+    def _prompt_prefix(self, custom_instruction_key: Optional[str] = None) -> Optional[str]:
+        """Input-independent start of the prompt built by _build_prompt, if known"""
+        instruction = self._instruction(custom_instruction_key)
+        if instruction is None:
+            return None
+        return f"{instruction.system_prompt}\n\n{instruction.template_prefix()}"
+    
+    def _get_default_prompt(self, input_text: str, context: str = "") -> str:
+        """Fallback prompt used when no instruction is registered for the agent's task"""
+        raise NotImplementedError
+    
+    def _build_result(self, input_text: str, response: str) -> Dict:
+        """Turn a raw model response into the agent's result dictionary"""
+        raise NotImplementedError
 
 
 class AmbiguityAgent(BaseAgent):
     """Independent agent for detecting ambiguity in user queries"""
     
-    def __init__(self, model_id: str, models_dir: str = "./models", device: Optional[str] = None):
-        super().__init__(model_id, models_dir, device)
+    max_new_tokens = 256
+    
+    # Labels scored by logits classification, and the text that makes one of them
+    # the next token
+    CLASSIFICATION_LABELS = ("Ambiguous", "Clear")
+    CLASSIFICATION_CUE = "\n1. Classification:"
+    
+    def __init__(self, model_id: str, models_dir: str = "./models", device: Optional[str] = None,
+                 quantization: str = "auto", backend: str = "eager",
+                 model_and_tokenizer: Optional[Tuple[Any, Any]] = None):
+        super().__init__(model_id, models_dir, device, quantization, backend, model_and_tokenizer)
         self.task = "ambiguity_detection"
+        
+        # First token id of each classification label, see enable_logits_classification()
+        self._label_ids: Optional[List[int]] = None
+    
+    def enable_logits_classification(self) -> bool:
+        """
+        Classify with a single forward pass instead of generating an assessment:
+        the label whose first token scores higher after the classification cue wins.
+        Results then carry only the label, no explanation.
+        
+        Returns:
+            Whether logits classification was enabled
+        """
+        if self.backend in SERVING_BACKENDS:
+            print(f"Logits classification is not supported by the {self.backend} backend")
+            return False
+        
+        cue_ids = self.tokenizer(self.CLASSIFICATION_CUE, add_special_tokens=False).input_ids
+        label_ids = []
+        for label in self.CLASSIFICATION_LABELS:
+            ids = self.tokenizer(f"{self.CLASSIFICATION_CUE} {label}", add_special_tokens=False).input_ids
+            if ids[:len(cue_ids)] != cue_ids or len(ids) == len(cue_ids):
+                print(f"Cannot isolate the first token of {label!r}; keeping generation")
+                return False
+            label_ids.append(ids[len(cue_ids)])
+        if len(set(label_ids)) != len(label_ids):
+            print("Classification labels share their first token; keeping generation")
+            return False
+        
+        self._label_ids = label_ids
+        return True
+    
+    def _classify_batch(self, prompts: List[str]) -> List[str]:
+        """Label for each prompt from the next-token logits after the classification cue"""
+        inputs = self._tokenize_batch([prompt + self.CLASSIFICATION_CUE for prompt in prompts], 1)
+        inputs = {
+            name: tensor.to(self.model.device, non_blocking=True)
+            for name, tensor in inputs.items()
+        }
+        # Left padding: positions must count only real tokens, as generate() does
+        position_ids = (inputs["attention_mask"].cumsum(-1) - 1).clamp(min=0)
+        
+        with self._generate_lock, torch.inference_mode():
+            logits = self.model(**inputs, position_ids=position_ids, use_cache=False).logits
+        
+        label_logits = logits[:, -1, self._label_ids]
+        return [self.CLASSIFICATION_LABELS[idx] for idx in label_logits.argmax(dim=-1).tolist()]
+    
+    def process_batch(self, input_texts: List[str], custom_instruction_key: Optional[str] = None,
+                      context: str = "") -> List[Dict]:
+        if self._label_ids is None:
+            return super().process_batch(input_texts, custom_instruction_key, context)
+        
+        prompts = [
+            self._build_prompt(text, custom_instruction_key, context)
+            for text in input_texts
+        ]
+        return [
+            self._build_result(text, label)
+            for text, label in zip(input_texts, self._classify_batch(prompts))
+        ]
+    
+    def process_stream(self, input_texts: List[str], batch_size: int,
+                       custom_instruction_key: Optional[str] = None,
+                       context: str = "") -> Iterator[Tuple[List[str], List[Dict], float]]:
+        if self._label_ids is None:
+            yield from super().process_stream(input_texts, batch_size, custom_instruction_key, context)
+            return
+        
+        for start in range(0, len(input_texts), batch_size):
+            batch = input_texts[start:start + batch_size]
+            batch_start = time.time()
+            batch_results = self.process_batch(batch, custom_instruction_key, context)
+            yield batch, batch_results, time.time() - batch_start
     
-    def process(self, input_text: str, custom_instruction_key: Optional[str] = None) -> Dict:
+    def process(self, input_text: str, custom_instruction_key: Optional[str] = None,
+                conversation_id: Optional[str] = None) -> Dict:
         """
         Detect ambiguity in input.
         
         Args:
             input_text: User input to analyze
             custom_instruction_key: Optional custom instruction key
+            conversation_id: Optional conversation this input continues
         
         Returns:
             Dictionary with ambiguity assessment
         """
-        if custom_instruction_key:
-            instruction = get_instruction(custom_instruction_key)
-            if instruction:
-                system_prompt, user_prompt = instruction.render_prompt(input_text, "")
-                prompt = f"{system_prompt}\n\n{user_prompt}"
-            else:
-                prompt = self._get_default_prompt(input_text)
-        else:
-            prompt = self._get_default_prompt(input_text)
+        if self._label_ids is not None:
+            # A single forward pass produces no turn text to add to a conversation
+            if conversation_id is not None:
+                raise ValueError("Logits classification does not support conversations; "
+                                 "call process() without conversation_id")
+            return self.process_batch([input_text], custom_instruction_key)[0]
         
-        response = self.generate(prompt, max_length=256)
+        response = self._generate_for_input(input_text, custom_instruction_key,
+                                            conversation_id=conversation_id)
         
+        return self._build_result(input_text, response)
+    
+    def _build_result(self, input_text: str, response: str) -> Dict:
         return {
             "input": input_text,
             "classification": self._extract_classification(response),
@@ -115,12 +1476,8 @@ class AmbiguityAgent(BaseAgent):
             "task": self.task
         }
     
-    def _get_default_prompt(self, input_text: str) -> str:
-        """Default ambiguity detection prompt - uses custom instruction"""
-        instruction = get_instruction("ambiguity_detection")
-        if instruction:
-            system_prompt, user_prompt = instruction.render_prompt(input_text, "")
-            return f"{system_prompt}\n\n{user_prompt}"
+    def _get_default_prompt(self, input_text: str, context: str = "") -> str:
+        """Fallback ambiguity detection prompt, used when no "ambiguity_detection" instruction is registered"""
         return f"""Analyze if this query is ambiguous or clear:
 
 Query: {input_text}
@@ -130,11 +1487,11 @@ Is this ambiguous? Provide classification (Ambiguous/Clear) and brief reason."""
     @staticmethod
     def _extract_classification(response: str) -> str:
         """Extract classification from response"""
-        response_lower = response.lower()
+        not_ambiguous = _NOT_AMBIGUOUS_RE.search(response) is not None
         
-        if "ambiguous" in response_lower and "not ambiguous" not in response_lower:
+        if not not_ambiguous and _AMBIGUOUS_RE.search(response):
             return "Ambiguous"
-        elif "clear" in response_lower or "not ambiguous" in response_lower:
+        elif not_ambiguous or _CLEAR_RE.search(response):
             return "Clear"
         else:
             return "Unknown"
@@ -143,12 +1500,16 @@ Is this ambiguous? Provide classification (Ambiguous/Clear) and brief reason."""
 class NLQAgent(BaseAgent):
     """Natural Language Query refinement agent"""
     
-    def __init__(self, model_id: str, models_dir: str = "./models", device: Optional[str] = None):
-        super().__init__(model_id, models_dir, device)
+    max_new_tokens = 256
+    
+    def __init__(self, model_id: str, models_dir: str = "./models", device: Optional[str] = None,
+                 quantization: str = "auto", backend: str = "eager",
+                 model_and_tokenizer: Optional[Tuple[Any, Any]] = None):
+        super().__init__(model_id, models_dir, device, quantization, backend, model_and_tokenizer)
         self.task = "nlq_refinement"
     
     def process(self, input_text: str, custom_instruction_key: Optional[str] = None, 
-                context: str = "") -> Dict:
+                context: str = "", conversation_id: Optional[str] = None) -> Dict:
         """
         Refine natural language query.
         
@@ -156,21 +1517,17 @@ class NLQAgent(BaseAgent):
             input_text: Original user query
             custom_instruction_key: Optional custom instruction key
             context: Optional context (e.g., ambiguity assessment)
+            conversation_id: Optional conversation this query continues
         
         Returns:
             Dictionary with refined query
         """
-        if custom_instruction_key:
-            instruction = get_instruction(custom_instruction_key)
-            if instruction:
-                system_prompt, user_prompt = instruction.render_prompt(input_text, context)
-                prompt = f"{system_prompt}\n\n{user_prompt}"
-            else:
-                prompt = self._get_default_prompt(input_text, context)
-        else:
-            prompt = self._get_default_prompt(input_text, context)
+        response = self._generate_for_input(input_text, custom_instruction_key, context,
+                                            conversation_id)
         
-        response = self.generate(prompt, max_length=256)
+        return self._build_result(input_text, response)
+    
+    def _build_result(self, input_text: str, response: str) -> Dict:
         refined_query = response.strip()
         
         return {
@@ -181,11 +1538,7 @@ class NLQAgent(BaseAgent):
         }
     
     def _get_default_prompt(self, input_text: str, context: str = "") -> str:
-        """Default NLQ refinement prompt - uses custom instruction"""
-        instruction = get_instruction("nlq_refinement")
-        if instruction:
-            system_prompt, user_prompt = instruction.render_prompt(input_text, context)
-            return f"{system_prompt}\n\n{user_prompt}"
+        """Fallback NLQ refinement prompt, used when no "nlq_refinement" instruction is registered"""
         return f"""Refine this user query to make it clearer and more specific:
 
 Original Query: {input_text}
@@ -203,12 +1556,24 @@ Refined Query:"""
 class SQLAgent(BaseAgent):
     """SQL generation agent that takes refined NLQ and generates SQL"""
     
-    def __init__(self, model_id: str, models_dir: str = "./models", device: Optional[str] = None):
-        super().__init__(model_id, models_dir, device)
+    max_new_tokens = 200
+    # SQL is a deterministic structured output: decode greedily
+    temperature = 0.0
+    # Stop decoding at the end of the first statement instead of running to max_new_tokens
+    stop_strings = (";",)
+    
+    def __init__(self, model_id: str, models_dir: str = "./models", device: Optional[str] = None,
+                 quantization: str = "auto", backend: str = "eager",
+                 model_and_tokenizer: Optional[Tuple[Any, Any]] = None):
+        super().__init__(model_id, models_dir, device, quantization, backend, model_and_tokenizer)
         self.task = "sql_generation"
+        # The SQL instruction carries a long constant system prompt; prefill it once
+        # up front so no request pays for it
+        self.warm_prefix_cache()
     
     def process(self, input_text: str, custom_instruction_key: Optional[str] = None,
-                context: str = "") -> Dict:
+                context: str = "", conversation_id: Optional[str] = None,
+                cancel_event: Optional[threading.Event] = None) -> Dict:
         """
         Generate SQL from refined NLQ.
         
@@ -216,21 +1581,19 @@ class SQLAgent(BaseAgent):
             input_text: Refined NLQ query
             custom_instruction_key: Optional custom instruction key
             context: Optional context (e.g., previous results)
+            conversation_id: Optional conversation this query continues
+            cancel_event: Optional event that stops the generation early when set
+                (see supports_cancellation())
         
         Returns:
             Dictionary with generated SQL
         """
-        if custom_instruction_key:
-            instruction = get_instruction(custom_instruction_key)
-            if instruction:
-                system_prompt, user_prompt = instruction.render_prompt(input_text, context)
-                prompt = f"{system_prompt}\n\n{user_prompt}"
-            else:
-                prompt = self._get_default_prompt(input_text, context)
-        else:
-            prompt = self._get_default_prompt(input_text, context)
+        response = self._generate_for_input(input_text, custom_instruction_key, context,
+                                            conversation_id, cancel_event)
         
-        response = self.generate(prompt, max_length=200)
+        return self._build_result(input_text, response)
+    
+    def _build_result(self, input_text: str, response: str) -> Dict:
         sql = self._extract_sql(response)
         
         return {
@@ -241,11 +1604,7 @@ class SQLAgent(BaseAgent):
         }
     
     def _get_default_prompt(self, input_text: str, context: str = "") -> str:
-        """Default SQL generation prompt - uses custom instruction"""
-        instruction = get_instruction("sql_generation")
-        if instruction:
-            system_prompt, user_prompt = instruction.render_prompt(input_text, context)
-            return f"{system_prompt}\n\n{user_prompt}"
+        """Fallback SQL generation prompt, used when no "sql_generation" instruction is registered"""
         return f"""Generate a SQL query for this request:
 
 Request: {input_text}
@@ -261,14 +1620,16 @@ SQL Query:"""
     
     @staticmethod
     def _extract_sql(response: str) -> str:
-        """Extract SQL from response"""
+        """
+        Extract SQL from response: the first statement up to and including its
+        semicolon, or, if there is none, everything up to the first blank line
+        """
         response = response.strip()
-        for prefix in ["SQL:", "sql:", "QUERY:", "Query:", "SELECT", "select"]:
-            if response.startswith(prefix):
-                response = response[len(prefix):].strip()
-                break
-        
-        lines = response.split('\n')
-        sql = lines[0].strip() if lines else response
+        match = _SQL_LABEL_RE.match(response)
+        if match:
+            response = response[match.end():]
         
-        return sql
+        statement, semicolon, _ = response.partition(';')
+        if semicolon:
+            return (statement + semicolon).strip()
+        return response.partition('\n\n')[0].replace('```', '').strip()